@@ -0,0 +1,54 @@
+import json
+
+import albumentations as A
+
+# the augmentations we train with, each transform is the name of an albumentations class and its arguments,
+# and transforms like OneOf take a list of transforms of their own
+DEFAULT_AUGMENTATIONS = {
+    'min_area': (1024 * 0.05) ** 2,
+    'min_visibility': 0.,
+    'transforms': [
+        {'type': 'VerticalFlip', 'p': 0.5},
+        {'type': 'HorizontalFlip', 'p': 0.5},
+        {'type': 'RGBShift', 'p': 0.5},
+        {'type': 'Blur', 'blur_limit': 7, 'p': 0.5},
+        {'type': 'GaussNoise', 'p': 0.5},
+        {'type': 'OpticalDistortion', 'distort_limit': 0.2, 'p': 0.5},
+        {'type': 'GridDistortion', 'p': 0.5},
+        {'type': 'ShiftScaleRotate', 'shift_limit': 0.1, 'rotate_limit': 45, 'scale_limit': 0.2, 'p': 0.75},
+    ],
+}
+
+
+def load_augmentation_config(path):
+    """ Read an augmentation config like DEFAULT_AUGMENTATIONS from a json file, or yaml if pyyaml is installed.
+    """
+    with open(path, 'r') as f:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            import yaml
+            return yaml.safe_load(f)
+
+        return json.load(f)
+
+
+def build_transform(spec):
+    params = dict(spec)
+    transform_class = getattr(A, params.pop('type'))
+
+    if 'transforms' in params:
+        params['transforms'] = [build_transform(child) for child in params['transforms']]
+
+    return transform_class(**params)
+
+
+def build_augmentations(config=None):
+    """ Build the albumentations pipeline for a config like DEFAULT_AUGMENTATIONS, for pascal_voc boxes.
+
+    The labels of the boxes are passed as category_id.
+    """
+    config = DEFAULT_AUGMENTATIONS if config is None else config
+
+    return A.Compose([build_transform(spec) for spec in config['transforms']],
+                     bbox_params={'format': 'pascal_voc', 'min_area': config.get('min_area', 0.),
+                                  'min_visibility': config.get('min_visibility', 0.),
+                                  'label_fields': ['category_id']})
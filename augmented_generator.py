@@ -1,17 +1,55 @@
-import albumentations as A
-from tif_generator import TiffGenerator
 import numpy as np
 
+from augmentations import DEFAULT_AUGMENTATIONS, build_augmentations
+from batch_augment import BatchAugmenter
+from crop_cache import CropCache
+from tif_generator import TiffGenerator
+
 class AugmentedGenerator(TiffGenerator):
     def __init__(
             self,
             csv_data_file,
             csv_class_file,
             base_dir=None,
+            augmentation_config=None,
+            augmentation_engine='albumentations',
             **kwargs
     ):
         super(AugmentedGenerator, self).__init__(csv_data_file, csv_class_file, base_dir, **kwargs)
 
+        # built once and reused for every sample, see augmentations.DEFAULT_AUGMENTATIONS
+        self.augmentations = build_augmentations(augmentation_config)
+
+        # or augment whole batches at once, with the transforms of the config that BatchAugmenter has
+        self.batch_augmenter = None
+        if augmentation_engine == 'batch':
+            config = DEFAULT_AUGMENTATIONS if augmentation_config is None else augmentation_config
+            self.batch_augmenter = BatchAugmenter.from_config(config, seed=self.seed)
+
+    def reseed_worker(self):
+        pid = self.pid
+        super(AugmentedGenerator, self).reseed_worker()
+
+        if self.pid != pid and self.batch_augmenter is not None:
+            self.batch_augmenter.reseed(np.random.randint(2 ** 31))
+
+    def preprocess_group(self, image_group, annotations_group):
+        if self.batch_augmenter is None:
+            return super(AugmentedGenerator, self).preprocess_group(image_group, annotations_group)
+
+        images, bboxes_group, labels_group = self.batch_augmenter(
+            np.stack(image_group),
+            [annotations['bboxes'] for annotations in annotations_group],
+            [annotations['labels'] for annotations in annotations_group]
+        )
+
+        for index, annotations in enumerate(annotations_group):
+            annotations['bboxes'] = bboxes_group[index]
+            annotations['labels'] = labels_group[index]
+            image_group[index] = self.preprocess_image(images[index])
+
+        return image_group, annotations_group
+
     def preprocess_group_entry(self, image, annotations):
         # augment images
         image, annotations = self.augment_image(image, annotations)
@@ -36,18 +74,7 @@ class AugmentedGenerator(TiffGenerator):
         if annotations['bboxes'].any():
             annotation = {'image': image, 'bboxes': annotations['bboxes'], 'category_id': annotations['labels']}
 
-            aug = self.get_aug([
-                A.VerticalFlip(),
-                A.HorizontalFlip(),
-                A.RGBShift(),
-                A.Blur(blur_limit=7),
-                A.GaussNoise(),
-                A.OpticalDistortion(distort_limit=0.2),
-                A.GridDistortion(),
-                A.ShiftScaleRotate(p=0.75, shift_limit=0.1, rotate_limit=45, scale_limit=0.2),
-            ], min_area=(1024*0.05)**2)
-
-            augmented = aug(**annotation)
+            augmented = self.augmentations(**annotation)
 
             image = augmented['image']
 
@@ -56,6 +83,39 @@ class AugmentedGenerator(TiffGenerator):
 
         return image, annotations
 
-    def get_aug(self, aug, min_area=0., min_visibility=0.):
-        return A.Compose(aug, bbox_params={'format': 'pascal_voc', 'min_area': min_area, 'min_visibility': min_visibility,
-                                         'label_fields': ['category_id']})
+
+class CachedCropGenerator(AugmentedGenerator):
+    """ An AugmentedGenerator that reads its crops from a cache made by crop_cache.py rather than from the tifs.
+
+    In epoch e it uses crop e % crops_per_annotation of each annotation, which are the windows the tif
+    generator would have read with the cache's seed in the first epochs.
+    """
+
+    def __init__(
+            self,
+            csv_data_file,
+            csv_class_file,
+            crop_cache,
+            base_dir=None,
+            **kwargs
+    ):
+        self.crop_cache = CropCache(crop_cache)
+        kwargs.setdefault('seed', self.crop_cache.seed)
+        super(CachedCropGenerator, self).__init__(csv_data_file, csv_class_file, base_dir, **kwargs)
+
+        if self.size() != self.crop_cache.num_annotations or self.image_min_side != self.crop_cache.image_min_side:
+            raise ValueError("crop cache {} was made from different annotations or a different image_min_side".format(
+                crop_cache))
+
+    def load_sample(self, annotation_index, slot=None):
+        # the repeat draws of an annotation in an epoch take a random crop each, as they would a random window
+        k = self.epoch
+        if slot is not None:
+            k = np.random.RandomState([self.seed, self.epoch] + [int(v) for v in slot]).randint(2 ** 31)
+        return self.crop_cache.crop(annotation_index, k % self.crop_cache.crops_per_annotation)
+
+    def load_image(self, annotation_index):
+        return self.load_sample(annotation_index)[0]
+
+    def load_annotations(self, annotation_index):
+        return self.load_sample(annotation_index)[1]
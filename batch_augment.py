@@ -0,0 +1,173 @@
+import warnings
+
+import cv2
+import numpy as np
+
+# the albumentations transforms BatchAugmenter can stand in for, the others in a config are skipped
+SUPPORTED_TRANSFORMS = ('VerticalFlip', 'HorizontalFlip', 'RGBShift', 'GaussNoise', 'ShiftScaleRotate')
+
+
+class BatchAugmenter(object):
+    """ Flips, RGB shift, gaussian noise and shift/scale/rotate applied to a whole batch of images at once.
+
+    A cheaper alternative to the albumentations pipeline for batches of same sized images. The colour
+    changes are a single pass over the batch, the noise is one field per batch rolled differently for
+    each image, and the boxes of every image are transformed together. Boxes are pascal_voc
+    [x1, y1, x2, y2] and are dropped if less than min_area or min_visibility of them is left in the image.
+    """
+
+    def __init__(self, vertical_flip_p=0.5, horizontal_flip_p=0.5, rgb_shift_limit=20, rgb_shift_p=0.5,
+                 noise_var_limit=(10., 50.), noise_p=0.5, shift_limit=0.1, scale_limit=0.2, rotate_limit=45,
+                 affine_p=0.75, min_area=0., min_visibility=0., seed=None):
+        self.vertical_flip_p = vertical_flip_p
+        self.horizontal_flip_p = horizontal_flip_p
+        self.rgb_shift_limit = rgb_shift_limit
+        self.rgb_shift_p = rgb_shift_p
+        self.noise_var_limit = noise_var_limit
+        self.noise_p = noise_p
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.affine_p = affine_p
+        self.min_area = min_area
+        self.min_visibility = min_visibility
+
+        self.rng = np.random.RandomState(seed)
+
+    @classmethod
+    def from_config(cls, config, seed=None):
+        """ The closest BatchAugmenter to an augmentation config like augmentations.DEFAULT_AUGMENTATIONS.
+        """
+        kwargs = {'vertical_flip_p': 0., 'horizontal_flip_p': 0., 'rgb_shift_p': 0., 'noise_p': 0., 'affine_p': 0.,
+                  'min_area': config.get('min_area', 0.), 'min_visibility': config.get('min_visibility', 0.)}
+
+        for spec in config['transforms']:
+            kind, p = spec['type'], spec.get('p', 0.5)
+            if kind not in SUPPORTED_TRANSFORMS:
+                warnings.warn('BatchAugmenter has no equivalent of {}, skipping it'.format(kind))
+            elif kind == 'VerticalFlip':
+                kwargs['vertical_flip_p'] = p
+            elif kind == 'HorizontalFlip':
+                kwargs['horizontal_flip_p'] = p
+            elif kind == 'RGBShift':
+                kwargs['rgb_shift_p'] = p
+                kwargs['rgb_shift_limit'] = spec.get('r_shift_limit', 20)
+            elif kind == 'GaussNoise':
+                kwargs['noise_p'] = p
+                kwargs['noise_var_limit'] = spec.get('var_limit', (10., 50.))
+            elif kind == 'ShiftScaleRotate':
+                kwargs['affine_p'] = p
+                kwargs['shift_limit'] = spec.get('shift_limit', 0.0625)
+                kwargs['scale_limit'] = spec.get('scale_limit', 0.1)
+                kwargs['rotate_limit'] = spec.get('rotate_limit', 45)
+
+        return cls(seed=seed, **kwargs)
+
+    def reseed(self, seed):
+        self.rng = np.random.RandomState(seed)
+
+    def __call__(self, images, bboxes_group, labels_group):
+        """ Augment a (batch, height, width, 3) uint8 array of images and the boxes and labels of each.
+
+        Returns the augmented images and lists of the boxes and labels that are left for each image.
+        """
+        batch, height, width = images.shape[:3]
+
+        # every box of the batch in one array, with the image it belongs to
+        counts = np.array([len(bboxes) for bboxes in bboxes_group], dtype=np.int64)
+        owner = np.repeat(np.arange(batch), counts)
+        bboxes = np.concatenate([np.asarray(bboxes, dtype=np.float32).reshape(-1, 4) for bboxes in bboxes_group])
+        labels = np.concatenate([np.asarray(labels).reshape(-1) for labels in labels_group])
+
+        images, bboxes = self.flip(images, bboxes, owner)
+        images, bboxes, visible = self.affine(images, bboxes, owner)
+        images = self.colour(images)
+
+        # drop the boxes that are mostly outside the image now
+        area = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+        keep = (area > 0) & (area >= self.min_area) & (visible >= self.min_visibility)
+
+        ends = np.cumsum(np.bincount(owner[keep], minlength=batch))
+        starts = ends - np.bincount(owner[keep], minlength=batch)
+        bboxes, labels = bboxes[keep], labels[keep]
+        return images, [bboxes[s:e] for s, e in zip(starts, ends)], [labels[s:e] for s, e in zip(starts, ends)]
+
+    def flip(self, images, bboxes, owner):
+        batch, height, width = images.shape[:3]
+        flip_v = self.rng.uniform(size=batch) < self.vertical_flip_p
+        flip_h = self.rng.uniform(size=batch) < self.horizontal_flip_p
+        if not flip_v.any() and not flip_h.any():
+            return images, bboxes
+
+        images = images.copy()
+        images[flip_v] = images[flip_v, ::-1]
+        images[flip_h] = images[flip_h, :, ::-1]
+
+        bboxes = bboxes.copy()
+        v, h = flip_v[owner], flip_h[owner]
+        bboxes[v, 1], bboxes[v, 3] = height - bboxes[v, 3], height - bboxes[v, 1]
+        bboxes[h, 0], bboxes[h, 2] = width - bboxes[h, 2], width - bboxes[h, 0]
+        return images, bboxes
+
+    def affine(self, images, bboxes, owner):
+        """ Shift, scale and rotate about the centre like albumentations' ShiftScaleRotate.
+
+        Returns the images, the bounding boxes of the transformed boxes clipped to the image and
+        the fraction of each box's area that is still inside the image.
+        """
+        batch, height, width = images.shape[:3]
+        chosen = self.rng.uniform(size=batch) < self.affine_p
+
+        matrices = np.tile(np.array([[1., 0., 0.], [0., 1., 0.]]), (batch, 1, 1))
+        angles = self.rng.uniform(-self.rotate_limit, self.rotate_limit, batch)
+        scales = self.rng.uniform(1 - self.scale_limit, 1 + self.scale_limit, batch)
+        shifts = self.rng.uniform(-self.shift_limit, self.shift_limit, (batch, 2)) * [width, height]
+
+        images = images.copy() if chosen.any() else images
+        for i in np.nonzero(chosen)[0]:
+            matrices[i] = cv2.getRotationMatrix2D((width / 2., height / 2.), angles[i], scales[i])
+            matrices[i, :, 2] += shifts[i]
+            images[i] = cv2.warpAffine(images[i], matrices[i], (width, height), flags=cv2.INTER_LINEAR,
+                                       borderMode=cv2.BORDER_REFLECT_101)
+
+        # transform the four corners of every box at once and take their bounding box
+        corners = np.stack((bboxes[:, [0, 1]], bboxes[:, [2, 1]], bboxes[:, [2, 3]], bboxes[:, [0, 3]]), axis=1)
+        box_matrices = matrices[owner]
+        corners = np.einsum('nij,nkj->nki', box_matrices[:, :, :2], corners) + box_matrices[:, np.newaxis, :, 2]
+        transformed = np.concatenate((corners.min(axis=1), corners.max(axis=1)), axis=1).astype(np.float32)
+
+        clipped = np.empty_like(transformed)
+        clipped[:, [0, 2]] = np.clip(transformed[:, [0, 2]], 0, width - 1)
+        clipped[:, [1, 3]] = np.clip(transformed[:, [1, 3]], 0, height - 1)
+
+        area = (transformed[:, 2] - transformed[:, 0]) * (transformed[:, 3] - transformed[:, 1])
+        clipped_area = (clipped[:, 2] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 1])
+        visible = np.where(area > 0, clipped_area / np.maximum(area, 1e-6), 0.)
+
+        return images, clipped, visible
+
+    def colour(self, images):
+        """ RGB shift and gaussian noise in a single float pass over the batch.
+        """
+        batch, height, width, channels = images.shape
+        shift = self.rng.uniform(-self.rgb_shift_limit, self.rgb_shift_limit, (batch, channels))
+        shift[self.rng.uniform(size=batch) >= self.rgb_shift_p] = 0
+
+        sigma = np.sqrt(self.rng.uniform(self.noise_var_limit[0], self.noise_var_limit[1], batch))
+        sigma[self.rng.uniform(size=batch) >= self.noise_p] = 0
+
+        if not shift.any() and not sigma.any():
+            return images
+
+        out = images.astype(np.float32)
+        out += shift[:, np.newaxis, np.newaxis, :].astype(np.float32)
+
+        if sigma.any():
+            # one noise field for the batch, rolled to a different place for each image
+            noise = self.rng.standard_normal((height, width, channels)).astype(np.float32)
+            for i in np.nonzero(sigma)[0]:
+                rolled = np.roll(noise, (self.rng.randint(height), self.rng.randint(width)), axis=(0, 1))
+                out[i] += sigma[i] * rolled
+
+        np.clip(out, 0, 255, out=out)
+        return out.astype(np.uint8)
@@ -0,0 +1,95 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from augmentations import DEFAULT_AUGMENTATIONS, build_augmentations, load_augmentation_config
+from batch_augment import SUPPORTED_TRANSFORMS, BatchAugmenter
+
+
+def make_synthetic_batch(batch_size=8, image_size=1024, boxes_per_image=30, seed=0):
+    """ Random images and boxes the size of the training crops.
+    """
+    rng = np.random.RandomState(seed)
+
+    images = rng.randint(0, 256, (batch_size, image_size, image_size, 3)).astype(np.uint8)
+    bboxes_group, labels_group = [], []
+    for _ in range(batch_size):
+        tl = rng.uniform(0, image_size - 120, (boxes_per_image, 2))
+        wh = rng.uniform(20, 120, (boxes_per_image, 2))
+        bboxes_group.append(np.concatenate((tl, tl + wh), axis=1).astype(np.float32))
+        labels_group.append(rng.randint(0, 3, boxes_per_image))
+
+    return images, bboxes_group, labels_group
+
+
+def time_albumentations(config, images, bboxes_group, labels_group, repeats):
+    """ The current path, the albumentations pipeline applied to one image at a time.
+    """
+    aug = build_augmentations(config)
+
+    start = time.time()
+    for _ in range(repeats):
+        for image, bboxes, labels in zip(images, bboxes_group, labels_group):
+            aug(image=image, bboxes=bboxes, category_id=labels)
+    return time.time() - start
+
+
+def time_batch(config, images, bboxes_group, labels_group, repeats):
+    aug = BatchAugmenter.from_config(config, seed=0)
+
+    start = time.time()
+    for _ in range(repeats):
+        aug(images, bboxes_group, labels_group)
+    return time.time() - start
+
+
+def run_benchmark(config=None, batch_size=8, image_size=1024, boxes_per_image=30, repeats=5):
+    """ Time both augmentation engines on the same synthetic batches, returning a dict of results per engine.
+    """
+    config = DEFAULT_AUGMENTATIONS if config is None else config
+    images, bboxes_group, labels_group = make_synthetic_batch(batch_size, image_size, boxes_per_image)
+
+    # albumentations with only the transforms the batch engine does too, for a like for like comparison
+    supported = dict(config, transforms=[spec for spec in config['transforms'] if spec['type'] in SUPPORTED_TRANSFORMS])
+
+    results = {}
+    for engine, timer, engine_config in (('albumentations', time_albumentations, config),
+                                         ('albumentations_supported', time_albumentations, supported),
+                                         ('batch', time_batch, config)):
+        seconds = timer(engine_config, images, bboxes_group, labels_group, repeats)
+        results[engine] = {
+            'seconds': seconds,
+            'images_per_sec': batch_size * repeats / seconds if seconds else None,
+        }
+
+    results['speedup'] = results['albumentations']['seconds'] / results['batch']['seconds']
+    results['speedup_supported'] = results['albumentations_supported']['seconds'] / results['batch']['seconds']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the albumentations and batch augmentation engines.')
+    parser.add_argument('--config', type=str, default=None, help='augmentation config to benchmark, see augmentations.py')
+    parser.add_argument('--batch-size', type=int, default=8, help='images per batch')
+    parser.add_argument('--image-size', type=int, default=1024, help='width and height of the images')
+    parser.add_argument('--boxes-per-image', type=int, default=30, help='boxes in each image')
+    parser.add_argument('--repeats', type=int, default=5, help='number of batches to time')
+    parser.add_argument('--output', type=str, default=None, help='write the json results here instead of stdout')
+    args = parser.parse_args()
+
+    config = load_augmentation_config(args.config) if args.config else None
+    results = run_benchmark(config, args.batch_size, args.image_size, args.boxes_per_image, args.repeats)
+    results['config'] = vars(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
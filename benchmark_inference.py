@@ -0,0 +1,255 @@
+import argparse
+import collections
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from osgeo import gdal
+
+from detections import CSVSink, batch_to_records, records_to_boxes
+from image_utils import drop_blank_offsets, pad_window, read_windows_banded, window_offsets
+from nms import non_max_suppression
+
+
+def make_synthetic_tif(path, width, height, nodata_fraction=0.2, building_density=1e-4, block_size=256, seed=0,
+                       overviews=(2, 4, 8, 16, 32), bands=3):
+    """ Write a tiled RGB GeoTIFF that looks enough like an orthomosaic to exercise the inference pipeline.
+
+    The left nodata_fraction of every row is 0, and the rest is textured ground with roughly
+    building_density buildings per pixel drawn on as coloured rectangles. With bands=3 the 0s are marked
+    as nodata, and with bands=4 there is an alpha band instead, 0 over the nodata and 255 elsewhere, like
+    most drone orthomosaics. overviews are the decimation factors of the overviews to build.
+    """
+    rng = np.random.RandomState(seed)
+
+    options = ['TILED=YES', 'BLOCKXSIZE={}'.format(block_size), 'BLOCKYSIZE={}'.format(block_size)]
+    if bands == 4:
+        options += ['PHOTOMETRIC=RGB', 'ALPHA=YES']
+
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, width, height, bands, gdal.GDT_Byte, options=options)
+    ds.SetGeoTransform((39.0, 1e-6, 0, -6.0, 0, -1e-6))
+    if bands == 3:
+        for b in range(3):
+            ds.GetRasterBand(b + 1).SetNoDataValue(0)
+
+    nodata_cols = int(width * nodata_fraction)
+    num_buildings = int(width * height * building_density)
+    building_x = rng.randint(nodata_cols, width, num_buildings)
+    building_y = rng.randint(0, height, num_buildings)
+    building_size = rng.randint(10, 60, (num_buildings, 2))
+    building_colour = rng.randint(1, 256, (num_buildings, 3))
+
+    # write a strip of blocks at a time so we never hold the whole image
+    for row in range(0, height, block_size):
+        strip_height = min(block_size, height - row)
+        strip = rng.randint(60, 140, (strip_height, width, 3)).astype(np.uint8)
+        strip[:, :nodata_cols] = 0
+
+        in_strip = (building_y + building_size[:, 1] > row) & (building_y < row + strip_height)
+        for x, y, (w, h), colour in zip(building_x[in_strip], building_y[in_strip],
+                                        building_size[in_strip], building_colour[in_strip]):
+            strip[max(y - row, 0):max(y + h - row, 0), x:x + w] = colour
+
+        for b in range(3):
+            ds.GetRasterBand(b + 1).WriteArray(strip[..., b], 0, row)
+        if bands == 4:
+            alpha = np.full((strip_height, width), 255, dtype=np.uint8)
+            alpha[:, :nodata_cols] = 0
+            ds.GetRasterBand(4).WriteArray(alpha, 0, row)
+
+    if overviews:
+        ds.BuildOverviews('AVERAGE', list(overviews))
+    ds.FlushCache()
+    return path
+
+
+class DummyModel(object):
+    """ Stands in for the RetinaNet model, returning random detections in the same layout.
+
+    The boxes are sorted by score and padded with -1 like the real model's filter_detections output.
+    predict_delay seconds per window can be added to mimic the cost of a forward pass.
+    """
+
+    def __init__(self, max_detections=300, detections_per_window=50, num_classes=3, predict_delay=0., seed=0):
+        self.max_detections = max_detections
+        self.detections_per_window = detections_per_window
+        self.num_classes = num_classes
+        self.predict_delay = predict_delay
+        self.rng = np.random.RandomState(seed)
+
+    def predict_on_batch(self, batch):
+        batch_size, height, width = batch.shape[:3]
+        if self.predict_delay:
+            time.sleep(self.predict_delay * batch_size)
+
+        n = self.max_detections
+        tl = self.rng.uniform(0, [width - 60, height - 60], (batch_size, n, 2))
+        wh = self.rng.uniform(10, 60, (batch_size, n, 2))
+        boxes = np.concatenate((tl, tl + wh), axis=2).astype(np.float32)
+
+        scores = np.full((batch_size, n), -1, dtype=np.float32)
+        found = self.rng.uniform(0, 1, (batch_size, self.detections_per_window))
+        scores[:, :self.detections_per_window] = -np.sort(-found, axis=1)
+        labels = self.rng.randint(0, self.num_classes, (batch_size, n))
+
+        return boxes, scores, labels
+
+
+class StageTimer(object):
+    """ Accumulates the time spent in each stage, and how many windows and bytes went through it.
+    """
+
+    def __init__(self):
+        self.seconds = collections.OrderedDict()
+        self.windows = collections.defaultdict(int)
+        self.bytes = collections.defaultdict(int)
+
+    @contextlib.contextmanager
+    def __call__(self, stage, windows, bytes_processed):
+        start = time.time()
+        yield
+        self.seconds[stage] = self.seconds.get(stage, 0.) + time.time() - start
+        self.windows[stage] += windows
+        self.bytes[stage] += bytes_processed
+
+    def results(self):
+        results = collections.OrderedDict()
+        for stage, seconds in self.seconds.items():
+            results[stage] = {
+                'seconds': seconds,
+                'windows': self.windows[stage],
+                'windows_per_sec': self.windows[stage] / seconds if seconds else None,
+                'mb_per_sec': self.bytes[stage] / 1e6 / seconds if seconds else None,
+            }
+        return results
+
+
+def run_benchmark(filepath, window_size=1024, window_step=256, batch_size=8, threshold=0.2, nms_overlap=0.15,
+                  max_windows=None, model=None, tmpdir=None):
+    """ Time each stage of the inference pipeline separately on filepath, returning a dict of results per stage.
+    """
+    # imported here so generating the synthetic tifs doesn't need tensorflow
+    from inference import predict_batch, preprocess_window
+
+    model = model or DummyModel()
+    labels_to_names = {label: 'class{}'.format(label) for label in range(model.num_classes)}
+
+    ds = gdal.Open(filepath)
+    offsets = window_offsets(ds.RasterYSize, ds.RasterXSize, window_size, window_step)
+    if max_windows:
+        offsets = offsets[:max_windows]
+    n = len(offsets)
+    window_bytes = window_size * window_size * ds.RasterCount
+
+    timer = StageTimer()
+
+    with timer('blank_mask', n, n * window_bytes):
+        drop_blank_offsets(ds, offsets, window_size)
+
+    with timer('read_banded', n, n * window_bytes):
+        for window, offset in read_windows_banded(ds, offsets, window_size):
+            pass
+
+    # the per window stages go a batch at a time, so we only hold one batch of pixels
+    records = []
+    for start in range(0, n, batch_size):
+        batch_offsets = offsets[start:start + batch_size]
+        batch_bytes = len(batch_offsets) * window_bytes
+
+        with timer('read_window', len(batch_offsets), batch_bytes):
+            raw = [pad_window(np.moveaxis(ds.ReadAsArray(int(col), int(row),
+                                                         min(window_size, ds.RasterXSize - int(col)),
+                                                         min(window_size, ds.RasterYSize - int(row)))[:3], 0, -1),
+                              window_size)
+                   for col, row in batch_offsets]
+
+        with timer('colour_conversion', len(batch_offsets), batch_bytes):
+            windows = [cv2.cvtColor(window, cv2.COLOR_RGB2BGR) for window in raw]
+
+        with timer('preprocess', len(batch_offsets), batch_bytes):
+            processed = [preprocess_window(window) for window in windows]
+
+        with timer('predict', len(batch_offsets), batch_bytes):
+            boxes, scores, labels = predict_batch(processed, model)
+
+        with timer('postprocess', len(batch_offsets), batch_bytes):
+            records.append(batch_to_records(boxes, scores, labels, batch_offsets, threshold)[0])
+
+    records = np.concatenate(records)
+    boxes = records_to_boxes(records).astype(np.float32)
+
+    with timer('nms', n, n * window_bytes):
+        non_max_suppression(boxes, records['score'], nms_overlap)
+
+    own_tmpdir = tmpdir is None
+    tmpdir = tmpdir or tempfile.mkdtemp()
+    try:
+        csvpath = os.path.join(tmpdir, 'intermediate.csv')
+        with timer('csv_write', n, 0):
+            with CSVSink(csvpath, filepath, labels_to_names) as sink:
+                for start in range(0, len(records), 64):
+                    sink.write_records(records[start:start + 64])
+                    sink.end_window()
+
+        # report the csv throughput in terms of what was written rather than the pixels
+        timer.bytes['csv_write'] = os.path.getsize(csvpath)
+    finally:
+        if own_tmpdir:
+            shutil.rmtree(tmpdir)
+
+    results = timer.results()
+    results['detections'] = int(len(records))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of inference on synthetic GeoTIFFs.')
+    parser.add_argument('--width', type=int, default=8192, help='width of the synthetic tif')
+    parser.add_argument('--height', type=int, default=4096, help='height of the synthetic tif')
+    parser.add_argument('--nodata-fraction', type=float, default=0.2, help='fraction of each row that is nodata')
+    parser.add_argument('--building-density', type=float, default=1e-4, help='buildings per pixel')
+    parser.add_argument('--block-size', type=int, default=256, help='tile size of the synthetic tif')
+    parser.add_argument('--bands', type=int, choices=[3, 4], default=3,
+                        help='3 for an RGB synthetic tif with nodata, 4 for RGBA with an alpha band')
+    parser.add_argument('--no-overviews', action='store_true',
+                        help='leave the overviews out of the synthetic tif, which turns off the blank mask')
+    parser.add_argument('--window-step', type=int, default=256, help='step of the sliding window')
+    parser.add_argument('--batch-size', type=int, default=8, help='windows per forward pass')
+    parser.add_argument('--max-windows', type=int, default=None, help='only time the first max_windows windows')
+    parser.add_argument('--detections-per-window', type=int, default=50,
+                        help='detections above threshold the dummy model returns for each window')
+    parser.add_argument('--predict-delay', type=float, default=0., help='seconds the dummy model takes per window')
+    parser.add_argument('--tif', type=str, default=None, help='benchmark this tif instead of a synthetic one')
+    parser.add_argument('--output', type=str, default=None, help='write the json results here instead of stdout')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filepath = args.tif or make_synthetic_tif(os.path.join(tmpdir, 'synthetic.tif'), args.width, args.height,
+                                                  args.nodata_fraction, args.building_density, args.block_size,
+                                                  overviews=None if args.no_overviews else (2, 4, 8, 16, 32),
+                                                  bands=args.bands)
+
+        model = DummyModel(detections_per_window=args.detections_per_window, predict_delay=args.predict_delay)
+        results = run_benchmark(filepath, window_step=args.window_step, batch_size=args.batch_size,
+                                max_windows=args.max_windows, model=model, tmpdir=tmpdir)
+        results['config'] = vars(args)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class BoxGrid(object):
+    """ A grid index over (n, 4) [x1, y1, x2, y2] boxes, for finding the boxes that overlap a window.
+
+    Each box is listed under every cell_size square cell it touches, stored as one array of box
+    indices sorted by cell with the start of each cell's run, so a query only looks at the boxes
+    in the cells the window covers.
+    """
+
+    def __init__(self, boxes, cell_size=1024):
+        self.boxes = np.asarray(boxes).reshape(-1, 4)
+        self.cell_size = cell_size
+
+        if len(self.boxes) == 0:
+            self.origin = np.zeros(2)
+            self.shape = (0, 0)
+            self.cell_starts = np.zeros(1, dtype=np.int64)
+            self.box_index = np.zeros(0, dtype=np.int64)
+            return
+
+        self.origin = self.boxes[:, :2].min(axis=0)
+        first = self._cells(self.boxes[:, :2])
+        last = self._cells(self.boxes[:, 2:])
+        self.shape = tuple(last.max(axis=0) + 1)
+
+        # one (cell, box) pair for every cell each box spans, boxes are small so this is a few per box
+        spans = last - first + 1
+        counts = spans[:, 0] * spans[:, 1]
+        box_index = np.repeat(np.arange(len(self.boxes)), counts)
+        step = np.arange(len(box_index)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = first[box_index, 0] + step % spans[box_index, 0]
+        cell_y = first[box_index, 1] + step // spans[box_index, 0]
+        cells = cell_y * self.shape[0] + cell_x
+
+        order = np.argsort(cells, kind='stable')
+        self.box_index = box_index[order]
+        self.cell_starts = np.concatenate(([0], np.cumsum(np.bincount(cells, minlength=self.shape[0] * self.shape[1]))))
+
+    def _cells(self, points):
+        return np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+
+    def candidates(self, x1, y1, x2, y2):
+        """ The indices, in order, of the boxes in the cells the window touches, a superset of those overlapping it.
+        """
+        if len(self.boxes) == 0:
+            return self.box_index
+
+        first = np.maximum(self._cells(np.array([x1, y1], dtype=np.float64)), 0)
+        last = np.minimum(self._cells(np.array([x2, y2], dtype=np.float64)), np.array(self.shape) - 1)
+        if (first > last).any():
+            return self.box_index[:0]
+
+        # each row of cells the window covers is one contiguous range of cell ids
+        rows = np.arange(first[1], last[1] + 1) * self.shape[0]
+        ranges = [self.box_index[self.cell_starts[row + first[0]]:self.cell_starts[row + last[0] + 1]] for row in rows]
+        return np.unique(np.concatenate(ranges))
+
+    def query(self, x1, y1, x2, y2):
+        """ The indices, in order, of the boxes whose intersection with the window has positive area.
+        """
+        index = self.candidates(x1, y1, x2, y2)
+        boxes = self.boxes[index]
+        overlaps = ((boxes[:, 0] < x2) & (boxes[:, 2] > x1) &
+                    (boxes[:, 1] < y2) & (boxes[:, 3] > y1))
+        return index[overlaps]
@@ -0,0 +1,137 @@
+import json
+import os
+
+import numpy as np
+
+METADATA_FILE = 'metadata.json'
+
+
+def shard_path(cache_dir, shard):
+    return os.path.join(cache_dir, 'crops-{:05d}.npy'.format(shard))
+
+
+def build_crop_cache(generator, cache_dir, crops_per_annotation=4, shard_size=1024):
+    """ Read crops_per_annotation windows around every annotation of a TiffGenerator into a crop cache.
+
+    Crop k of an annotation is the window the generator would sample for it in epoch k, so training from
+    the cache sees the same crops as training from the tifs for the first crops_per_annotation epochs.
+    The crops go into .npy shards of shard_size crops each, crop j being row j % shard_size of shard
+    j // shard_size, with the boxes of every crop in one array and box_offsets[j] the first of crop j's.
+    metadata.json is written last, so a cache that was interrupted is never mistaken for a finished one.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    num_annotations = generator.size()
+    num_crops = num_annotations * crops_per_annotation
+    side = generator.image_min_side
+
+    windows = np.zeros((num_crops, 2), dtype=np.int32)
+    box_counts = np.zeros(num_crops, dtype=np.int64)
+    boxes, labels = [], []
+
+    epoch = generator.epoch
+    shard = None
+    try:
+        for crop in range(num_crops):
+            annotation_index, k = divmod(crop, crops_per_annotation)
+
+            if crop % shard_size == 0:
+                shard = np.lib.format.open_memmap(shard_path(cache_dir, crop // shard_size), mode='w+', dtype=np.uint8,
+                                                  shape=(min(shard_size, num_crops - crop), side, side, 3))
+
+            # the window load_image would have picked in epoch k
+            generator.epoch = k
+            ds, window = generator.load_window(annotation_index)
+            annotations = generator.window_annotations(generator.image_data_to_image_index[annotation_index], window)
+
+            shard[crop % shard_size] = generator.read_window(ds, window)
+            windows[crop] = window
+            box_counts[crop] = len(annotations['bboxes'])
+            boxes.append(annotations['bboxes'])
+            labels.append(annotations['labels'])
+
+            if (crop + 1) % shard_size == 0:
+                shard.flush()
+            if (annotation_index + 1) % 1000 == 0 and k == crops_per_annotation - 1:
+                print("{}/{} annotations cached".format(annotation_index + 1, num_annotations))
+    finally:
+        generator.epoch = epoch
+
+    if shard is not None:
+        shard.flush()
+
+    np.save(os.path.join(cache_dir, 'windows.npy'), windows)
+    np.save(os.path.join(cache_dir, 'box_offsets.npy'), np.concatenate(([0], np.cumsum(box_counts))))
+    np.save(os.path.join(cache_dir, 'boxes.npy'),
+            np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32))
+    np.save(os.path.join(cache_dir, 'labels.npy'),
+            np.concatenate(labels) if labels else np.zeros((0,), dtype=np.int32))
+
+    with open(os.path.join(cache_dir, METADATA_FILE), 'w') as f:
+        json.dump({
+            'num_annotations': num_annotations,
+            'crops_per_annotation': crops_per_annotation,
+            'shard_size': shard_size,
+            'image_min_side': side,
+            'seed': int(generator.seed),
+        }, f, indent=2)
+
+
+class CropCache(object):
+    """ Reads a cache written by build_crop_cache, the crops are memory mapped so nothing is read until used.
+    """
+
+    def __init__(self, cache_dir):
+        metadata_path = os.path.join(cache_dir, METADATA_FILE)
+        if not os.path.exists(metadata_path):
+            raise IOError("{} is not a finished crop cache, it has no {}".format(cache_dir, METADATA_FILE))
+
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+
+        self.num_annotations = metadata['num_annotations']
+        self.crops_per_annotation = metadata['crops_per_annotation']
+        self.shard_size = metadata['shard_size']
+        self.image_min_side = metadata['image_min_side']
+        self.seed = metadata['seed']
+
+        num_crops = self.num_annotations * self.crops_per_annotation
+        num_shards = -(-num_crops // self.shard_size)
+        self.shards = [np.load(shard_path(cache_dir, shard), mmap_mode='r') for shard in range(num_shards)]
+
+        self.windows = np.load(os.path.join(cache_dir, 'windows.npy'))
+        self.box_offsets = np.load(os.path.join(cache_dir, 'box_offsets.npy'))
+        self.boxes = np.load(os.path.join(cache_dir, 'boxes.npy'))
+        self.labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+
+    def crop(self, annotation_index, k):
+        """ The image, annotations and window of crop k of an annotation, the image is a read only view of the shard.
+        """
+        crop = annotation_index * self.crops_per_annotation + k
+        start, end = self.box_offsets[crop], self.box_offsets[crop + 1]
+
+        image = self.shards[crop // self.shard_size][crop % self.shard_size]
+        annotations = {'labels': self.labels[start:end], 'bboxes': self.boxes[start:end].copy()}
+        return image, annotations, tuple(self.windows[crop])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from tif_generator import TiffGenerator
+
+    parser = argparse.ArgumentParser(description='Cache crops around every training annotation, for --crop-cache.')
+    parser.add_argument('annotations', help='Path to CSV file containing annotations for training.')
+    parser.add_argument('classes', help='Path to a CSV file containing class label mapping.')
+    parser.add_argument('cache_dir', help='Directory to write the crop cache to.')
+    parser.add_argument('--crops-per-annotation', help='Number of random crops to cache around each annotation.',
+                        type=int, default=4)
+    parser.add_argument('--shard-size', help='Number of crops in each file of the cache.', type=int, default=1024)
+    parser.add_argument('--image-min-side', help='Size of the crops.', type=int, default=1024)
+    parser.add_argument('--seed', help='Seed of the random windows.', type=int, default=None)
+    args = parser.parse_args()
+
+    generator = TiffGenerator(args.annotations, args.classes, image_min_side=args.image_min_side,
+                              image_max_side=args.image_min_side, seed=args.seed)
+    build_crop_cache(generator, args.cache_dir, args.crops_per_annotation, args.shard_size)
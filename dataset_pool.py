@@ -0,0 +1,71 @@
+import collections
+import os
+import threading
+
+from osgeo import gdal
+
+
+class DatasetPool(object):
+    """ A least recently used pool of open gdal datasets, keyed by path.
+
+    Opening a tif parses its header and tile index, which for a large orthomosaic costs more than
+    reading a 1024px window from it, so we keep up to size of them open. A dataset can't be used by
+    two threads at once, so each thread has its own pool. The handles belong to the process that
+    opened them: after a fork the pool notices the pid has changed and starts empty, and pickling
+    (for spawned workers) drops them, so every worker opens its own.
+
+    If cache_mb is given it sets the size of gdal's block cache, which is shared by every dataset
+    in the process.
+    """
+
+    def __init__(self, size=8, cache_mb=None):
+        self.size = size
+        self.cache_mb = cache_mb
+
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.local = threading.local()
+
+        if self.cache_mb is not None:
+            gdal.SetCacheMax(int(self.cache_mb) * 1024 * 1024)
+
+    def get(self, path):
+        """ The open dataset for path, opening it (and closing the least recently used one) if need be.
+        """
+        if os.getpid() != self.pid:
+            # we are in a forked worker, the parent's handles share its file offsets so don't touch them
+            self._reset()
+
+        datasets = self._datasets()
+        ds = datasets.pop(path, None)
+        if ds is None:
+            ds = gdal.Open(path)
+            if ds is None:
+                raise IOError("gdal could not open {}".format(path))
+
+            while len(datasets) >= self.size:
+                datasets.popitem(last=False)
+
+        datasets[path] = ds
+        return ds
+
+    def clear(self):
+        self._datasets().clear()
+
+    def __len__(self):
+        return len(self._datasets())
+
+    def _datasets(self):
+        if not hasattr(self.local, 'datasets'):
+            self.local.datasets = collections.OrderedDict()
+        return self.local.datasets
+
+    def __getstate__(self):
+        return {'size': self.size, 'cache_mb': self.cache_mb}
+
+    def __setstate__(self, state):
+        self.size = state['size']
+        self.cache_mb = state['cache_mb']
+        self._reset()
@@ -0,0 +1,61 @@
+import os
+import queue
+import threading
+
+import cv2
+
+from preprocess_data.draw_bounding_box import class_colors, visualize_bbox
+
+
+class DebugRenderer(object):
+    """ Draws the detections of every `every`th window and saves them to outdir, on a background thread.
+
+    Windows are dropped rather than queued when the renderer falls behind, so it never slows inference down.
+    """
+
+    def __init__(self, outdir, name, labels_to_names, every=100, queue_depth=8):
+        self.outdir = outdir
+        self.name = name
+        self.labels_to_names = labels_to_names
+        self.every = every
+
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+
+        self.count = 0
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, window, offset, boxes, scores, labels):
+        """ Maybe render a window, the boxes are relative to the window.
+        """
+        self.count += 1
+        if (self.count - 1) % self.every != 0:
+            return
+
+        try:
+            self.queue.put_nowait((window, offset, boxes, scores, labels))
+        except queue.Full:
+            pass
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            window, offset, boxes, scores, labels = item
+
+            # draw on a copy, the window may still be in use by the readers
+            img = window.copy()
+            for box, score, label in zip(boxes, scores, labels):
+                class_name = self.labels_to_names[label]
+                visualize_bbox(img, box, class_name, class_colors.get(class_name, (255, 255, 255)), score=score)
+
+            outfile = os.path.join(self.outdir, "{}_{}_{}.jpg".format(self.name, int(offset[0]), int(offset[1])))
+            cv2.imwrite(outfile, img)
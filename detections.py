@@ -0,0 +1,386 @@
+import csv
+import glob
+import os
+
+import numpy as np
+
+# a single detection in tif pixel coordinates, as stored by BinarySink
+DETECTION_DTYPE = np.dtype([
+    ('x1', np.int32),
+    ('y1', np.int32),
+    ('x2', np.int32),
+    ('y2', np.int32),
+    ('label', np.int32),
+    ('score', np.float32),
+])
+
+
+def records_to_boxes(records):
+    return np.stack((records['x1'], records['y1'], records['x2'], records['y2']), axis=1)
+
+
+def records_to_rows(filepath, records, labels_to_names):
+    """ Rows of filepath, x1, y1, x2, y2, class name, score, as written to the output csvs.
+    """
+    return [[filepath, r['x1'], r['y1'], r['x2'], r['y2'], labels_to_names[r['label']], r['score']]
+            for r in records]
+
+
+def batch_to_records(boxes, scores, labels, offsets, threshold):
+    """ Convert the model output for a batch of windows to records in tif coordinates, all at once.
+
+    boxes, scores and labels are the (batch, n, ...) outputs of predict_on_batch and offsets the
+    [col, row] of each window. Returns the records above threshold, grouped by window in batch order,
+    the index of the window each came from and the boxes relative to their window.
+    """
+    window_index, detection_index = np.nonzero(scores >= threshold)
+
+    local_boxes = boxes[window_index, detection_index].astype(np.int32)
+    window_offsets = np.asarray(offsets, dtype=np.int32)[window_index]
+
+    records = np.empty(len(window_index), dtype=DETECTION_DTYPE)
+    records['x1'] = local_boxes[:, 0] + window_offsets[:, 0]
+    records['y1'] = local_boxes[:, 1] + window_offsets[:, 1]
+    records['x2'] = local_boxes[:, 2] + window_offsets[:, 0]
+    records['y2'] = local_boxes[:, 3] + window_offsets[:, 1]
+    records['label'] = labels[window_index, detection_index]
+    records['score'] = scores[window_index, detection_index]
+
+    return records, window_index, local_boxes
+
+
+class DetectionBuffer(object):
+    """ A growable array of DETECTION_DTYPE records, doubling its capacity when it runs out of room.
+    """
+
+    def __init__(self, capacity=1024):
+        self.data = np.empty(capacity, dtype=DETECTION_DTYPE)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def records(self):
+        return self.data[:self.size]
+
+    def append(self, records):
+        end = self.size + len(records)
+        if end > len(self.data):
+            data = np.empty(max(end, 2 * len(self.data)), dtype=DETECTION_DTYPE)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+        self.data[self.size:end] = records
+        self.size = end
+
+    def clear(self):
+        self.size = 0
+
+
+class WindowCheckpoint(object):
+    """ A manifest of the windows of a tif whose detections are safely in the intermediate sink.
+
+    Each line is the col,row of a finished window and the number of detections the sink held once it was
+    written, and the last line is "done" once the final output has been written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self.windows = set()
+        self.count = 0
+        self.complete = False
+
+        if os.path.exists(path):
+            # a crash mid write can leave a partial last line, e.g. "512,0" or a count cut short, so we stop at
+            # the first line that isn't whole and cut the file back to it before appending
+            valid = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    if line.strip() == b"done":
+                        self.complete = True
+                    elif line.strip():
+                        try:
+                            col, row, count = [int(v) for v in line.split(b",")]
+                        except ValueError:
+                            break
+                        self.windows.add((col, row))
+                        self.count = count
+                    valid += len(line)
+
+            if valid < os.path.getsize(path):
+                os.truncate(path, valid)
+
+        self.file = open(path, "a")
+
+    def is_done(self, offset):
+        return (int(offset[0]), int(offset[1])) in self.windows
+
+    def mark(self, offsets, count):
+        for col, row in offsets:
+            self.windows.add((int(col), int(row)))
+            self.file.write("{},{},{}\n".format(int(col), int(row), count))
+        self.count = count
+        self.file.flush()
+
+    def finish(self):
+        self.complete = True
+        self.file.write("done\n")
+        self.file.flush()
+
+    def reset(self):
+        self.windows = set()
+        self.count = 0
+        self.complete = False
+
+        self.file.close()
+        self.file = open(self.path, "w")
+
+    def close(self):
+        self.file.close()
+
+
+class DetectionSink(object):
+    """ Buffers the detections of a tif and writes them out every flush_every windows.
+
+    Call end_window() after writing each window's detections, so that whatever is on disk always
+    covers whole windows. If a checkpoint is given the windows are marked in it after every flush,
+    so a crashed run can be picked up from the last flushed window.
+    """
+
+    extension = None
+
+    def __init__(self, path, filepath, labels_to_names, flush_every=1, checkpoint=None, written=0):
+        self.path = path
+        self.filepath = filepath
+        self.labels_to_names = labels_to_names
+        self.flush_every = flush_every
+        self.checkpoint = checkpoint
+
+        self.buffer = DetectionBuffer()
+        self.buffer_windows = []
+        self.windows = 0
+        self.written = written
+
+    @classmethod
+    def read(cls, path, labels_to_names):
+        """ Read back the DETECTION_DTYPE records a sink of this kind wrote to path.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def truncate(cls, path, count):
+        """ Drop everything after the first count records, e.g. detections of windows a crash left unmarked.
+        """
+        raise NotImplementedError
+
+    def write_records(self, records):
+        self.buffer.append(records)
+
+    def end_window(self, offset=None):
+        self.windows += 1
+        if offset is not None:
+            self.buffer_windows.append(offset)
+
+        if self.windows % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        records = self.buffer.records
+        self._write(records)
+        self.buffer.clear()
+        self.written += len(records)
+
+        # only mark the windows once their detections are on disk
+        if self.checkpoint is not None and self.buffer_windows:
+            self.checkpoint.mark(self.buffer_windows, self.written)
+        self.buffer_windows = []
+
+    def close(self):
+        self.flush()
+
+    def _write(self, records):
+        raise NotImplementedError
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CSVSink(DetectionSink):
+    """ Rows of filepath, x1, y1, x2, y2, class name, score, the same as the final output csv.
+    """
+
+    extension = '.csv'
+
+    def __init__(self, path, filepath, labels_to_names, flush_every=1, checkpoint=None, written=0):
+        super(CSVSink, self).__init__(path, filepath, labels_to_names, flush_every, checkpoint, written)
+        self.file = open(path, 'a' if written else 'w')
+        self.writer = csv.writer(self.file)
+
+    @classmethod
+    def read(cls, path, labels_to_names):
+        names_to_labels = {name: label for label, name in labels_to_names.items()}
+
+        with open(path, 'r') as f:
+            rows = [row for row in csv.reader(f) if row]
+
+        records = np.empty(len(rows), dtype=DETECTION_DTYPE)
+        for i, (filepath, x1, y1, x2, y2, class_name, score) in enumerate(rows):
+            records[i] = (int(x1), int(y1), int(x2), int(y2), names_to_labels[class_name], float(score))
+        return records
+
+    @classmethod
+    def truncate(cls, path, count):
+        with open(path, 'rb+') as f:
+            for _ in range(count):
+                f.readline()
+            f.truncate()
+
+    def _write(self, records):
+        self.writer.writerows(records_to_rows(self.filepath, records, self.labels_to_names))
+        self.file.flush()
+
+    def close(self):
+        super(CSVSink, self).close()
+        self.file.close()
+
+
+class BinarySink(DetectionSink):
+    """ An append only log of DETECTION_DTYPE records, read back with np.fromfile(path, dtype=DETECTION_DTYPE).
+    """
+
+    extension = '.det'
+
+    def __init__(self, path, filepath, labels_to_names, flush_every=1, checkpoint=None, written=0):
+        super(BinarySink, self).__init__(path, filepath, labels_to_names, flush_every, checkpoint, written)
+        self.file = open(path, 'ab' if written else 'wb')
+
+    @classmethod
+    def read(cls, path, labels_to_names):
+        return np.fromfile(path, dtype=DETECTION_DTYPE)
+
+    @classmethod
+    def truncate(cls, path, count):
+        os.truncate(path, count * DETECTION_DTYPE.itemsize)
+
+    def _write(self, records):
+        records.tofile(self.file)
+        self.file.flush()
+
+    def close(self):
+        super(BinarySink, self).close()
+        self.file.close()
+
+
+def _parquet_parts(path):
+    return sorted(glob.glob(os.path.join(path, 'part-*.parquet')))
+
+
+class ParquetSink(DetectionSink):
+    """ A directory of parquet files, one per flush, readable as a single dataset.
+
+    A parquet file can only be read once it is closed, so every flush writes a new part rather than
+    appending to one file that a crash would leave unreadable. Requires pyarrow.
+    """
+
+    extension = '.parquet'
+
+    def __init__(self, path, filepath, labels_to_names, flush_every=100, checkpoint=None, written=0):
+        import pyarrow
+        import pyarrow.parquet
+
+        super(ParquetSink, self).__init__(path, filepath, labels_to_names, flush_every, checkpoint, written)
+        self.pyarrow = pyarrow
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # unless we are appending, start a fresh dataset, the same as opening a file for writing
+        if not written:
+            for part in _parquet_parts(path):
+                os.remove(part)
+        self.parts = len(_parquet_parts(path))
+
+    @classmethod
+    def read(cls, path, labels_to_names):
+        import pyarrow.parquet
+
+        records = [np.empty((0,), dtype=DETECTION_DTYPE)]
+        for part in _parquet_parts(path):
+            table = pyarrow.parquet.read_table(part, columns=list(DETECTION_DTYPE.names))
+            part_records = np.empty(table.num_rows, dtype=DETECTION_DTYPE)
+            for name in DETECTION_DTYPE.names:
+                part_records[name] = table.column(name).to_numpy()
+            records.append(part_records)
+
+        return np.concatenate(records)
+
+    @classmethod
+    def truncate(cls, path, count):
+        import pyarrow.parquet
+
+        # parts are written a flush at a time and windows are only marked after, so parts never straddle count
+        total = 0
+        for part in _parquet_parts(path):
+            if total >= count:
+                os.remove(part)
+            total += pyarrow.parquet.ParquetFile(part).metadata.num_rows
+
+    def _write(self, records):
+        if not len(records):
+            return
+
+        table = self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(records[name]) for name in DETECTION_DTYPE.names] +
+            [self.pyarrow.array([self.labels_to_names[label] for label in records['label']])],
+            names=list(DETECTION_DTYPE.names) + ['class']
+        )
+        self.pyarrow.parquet.write_table(table, os.path.join(self.path, 'part-{:05d}.parquet'.format(self.parts)))
+        self.parts += 1
+
+
+SINKS = {
+    'csv': CSVSink,
+    'bin': BinarySink,
+    'parquet': ParquetSink,
+}
+
+
+def sink_path(kind, path_prefix):
+    return path_prefix + SINKS[kind].extension
+
+
+def make_sink(kind, path_prefix, filepath, labels_to_names, flush_every=None, checkpoint=None):
+    """ Create the sink of the given kind, writing to path_prefix plus the sink's extension.
+    """
+    sink_class = SINKS[kind]
+    kwargs = {} if flush_every is None else {'flush_every': flush_every}
+    return sink_class(sink_path(kind, path_prefix), filepath, labels_to_names, checkpoint=checkpoint, **kwargs)
+
+
+def read_detections(kind, path_prefix, labels_to_names):
+    """ Read back the records written by make_sink(kind, path_prefix, ...).
+    """
+    return SINKS[kind].read(sink_path(kind, path_prefix), labels_to_names)
+
+
+def resume_sink(kind, path_prefix, filepath, labels_to_names, checkpoint, flush_every=None):
+    """ Reopen the sink of an interrupted run, keeping only the detections of the windows in checkpoint.
+
+    Returns the sink, which carries on appending, and the records that were kept.
+    """
+    sink_class = SINKS[kind]
+    path = sink_path(kind, path_prefix)
+
+    sink_class.truncate(path, checkpoint.count)
+    records = sink_class.read(path, labels_to_names)
+
+    kwargs = {} if flush_every is None else {'flush_every': flush_every}
+    sink = sink_class(path, filepath, labels_to_names, checkpoint=checkpoint, written=len(records), **kwargs)
+    return sink, records
@@ -2,87 +2,255 @@ import numpy as np
 from osgeo import gdal
 import cv2
 
+from nms import non_max_suppression
+
 def im2windows(im, window_size=225, window_step=225):
     rows,cols,depth = im.shape
-    row_start_index = np.arange(0, rows-window_size, step=window_step)
-    col_start_index = np.arange(0, cols-window_size, step=window_step)
+    row_start_index = window_starts(rows, window_size, window_step)
+    col_start_index = window_starts(cols, window_size, window_step)
 
     num_windows = row_start_index.shape[0] * col_start_index.shape[0]
     windows = []
-    windows_tl_indexs = np.zeros((num_windows, 2), dtype=np.int)
+    windows_tl_indexs = np.zeros((num_windows, 2), dtype=int)
     i = 0
     for row in row_start_index:
         for col in col_start_index:
-            windows.append(im[row:row+window_size, col:col+window_size, :])
+            windows.append(pad_window(im[row:row+window_size, col:col+window_size, :], window_size))
             windows_tl_indexs[i] = [col, row]
             i = i + 1
 
     return windows, windows_tl_indexs
 
-def large_tiff_to_windows(filepath, window_size=1024, window_step=512):
+def window_starts(length, window_size=1024, window_step=512):
+    """ The starts of the windows along an axis of the given length, so that every pixel is in a window.
+
+    The windows step along as usual, and if that leaves a strip at the end uncovered we add one more
+    window aligned with the end rather than shrinking the step. An axis shorter than a window gets a
+    single window at 0, which is padded when read.
+    """
+    if length <= window_size:
+        return np.array([0])
+
+    starts = np.arange(0, length - window_size + 1, step=window_step)
+    if starts[-1] != length - window_size:
+        starts = np.append(starts, length - window_size)
+    return starts
+
+
+def window_offsets(rows, cols, window_size=1024, window_step=512):
+    row_start_index = window_starts(rows, window_size, window_step)
+    col_start_index = window_starts(cols, window_size, window_step)
+
+    # the [col, row] top left of every window, in the order we read them
+    cols_grid, rows_grid = np.meshgrid(col_start_index, row_start_index)
+    return np.stack((cols_grid.ravel(), rows_grid.ravel()), axis=1)
+
+
+def large_tiff_window_offsets(filepath, window_size=1024, window_step=512):
     ds = gdal.Open(filepath)
+    return window_offsets(ds.RasterYSize, ds.RasterXSize, window_size, window_step)
 
-    rows, cols, depth = ds.RasterYSize, ds.RasterXSize, ds.RasterCount
-    row_start_index = np.arange(0, rows - window_size, step=window_step)
-    col_start_index = np.arange(0, cols - window_size, step=window_step)
 
-    total = len(row_start_index) * len(col_start_index)
+def coarse_validity(ds, factor=32):
+    """ Read the tif at 1/factor resolution to find where there is data, without decoding it all.
 
-    for row in row_start_index:
-        for col in col_start_index:
-            ds_array = ds.ReadAsArray(int(col), int(row), window_size, window_size)
-            satim = np.moveaxis(ds_array, 0, -1)
-            satim = cv2.cvtColor(satim, cv2.COLOR_RGB2BGR)
+    If the tif has a mask band (alpha or nodata) we return (mask, True) where the mask is non zero over
+    cells that contain any valid pixel. Otherwise we return (image, False), the averaged bands, and a
+    region is considered blank if it is one flat colour like the original min == max check.
+    GDAL uses the tif's overviews for these decimated reads when it has them, without them it
+    decodes every pixel of the tif.
+    """
+    buf_xsize = max(1, -(-ds.RasterXSize // factor))
+    buf_ysize = max(1, -(-ds.RasterYSize // factor))
+
+    band = ds.GetRasterBand(1)
+    if not band.GetMaskFlags() & gdal.GMF_ALL_VALID:
+        mask = band.GetMaskBand().ReadAsArray(buf_xsize=buf_xsize, buf_ysize=buf_ysize,
+                                              resample_alg=gdal.GRIORA_Average)
+        return mask, True
+
+    coarse = ds.ReadAsArray(buf_xsize=buf_xsize, buf_ysize=buf_ysize, resample_alg=gdal.GRIORA_Average)
+    if coarse.ndim == 2:
+        coarse = coarse[np.newaxis]
+    return coarse, False
+
+
+def drop_blank_offsets(ds, offsets, window_size=1024, factor=32):
+    """ Remove the offsets of windows that contain no data according to coarse_validity.
+
+    This is only cheap when the tif has overviews, so without them we keep every offset and leave
+    the blank windows to be skipped once they are read.
+    """
+    if not ds.GetRasterBand(1).GetOverviewCount():
+        return offsets
+
+    coarse, is_mask = coarse_validity(ds, factor)
+    coarse_rows, coarse_cols = coarse.shape[-2:]
+    scale_y = coarse_rows / float(ds.RasterYSize)
+    scale_x = coarse_cols / float(ds.RasterXSize)
+
+    keep = np.zeros(len(offsets), dtype=bool)
+    for i, (col, row) in enumerate(offsets):
+        # every coarse cell the window touches, even partially
+        r0, r1 = int(row * scale_y), int(np.ceil((row + window_size) * scale_y))
+        c0, c1 = int(col * scale_x), int(np.ceil((col + window_size) * scale_x))
+        cells = coarse[..., r0:r1, c0:c1]
+
+        if is_mask:
+            keep[i] = cells.any()
+        else:
+            keep[i] = cells.min() != cells.max()
+
+    return offsets[keep]
+
+
+def offsets_near_boxes(offsets, boxes, rows, cols, window_size=1024, margin=0, cell_size=64):
+    """ Keep the offsets of the windows that intersect any of the (n, 4) [x1, y1, x2, y2] boxes grown by margin.
+
+    The boxes are painted onto a grid of cell_size pixels and each window is tested with a summed area
+    table, so this is linear in the number of windows and boxes rather than their product.
+    """
+    grid_rows = -(-rows // cell_size) + 1
+    grid_cols = -(-cols // cell_size) + 1
+    if len(offsets) == 0 or len(boxes) == 0:
+        return offsets[:0]
+
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    x1 = np.clip((boxes[:, 0] - margin) // cell_size, 0, grid_cols - 1).astype(int)
+    y1 = np.clip((boxes[:, 1] - margin) // cell_size, 0, grid_rows - 1).astype(int)
+    x2 = np.clip((boxes[:, 2] + margin) // cell_size + 1, 0, grid_cols).astype(int)
+    y2 = np.clip((boxes[:, 3] + margin) // cell_size + 1, 0, grid_rows).astype(int)
+
+    # paint the boxes with a 2d difference array, then integrate it to get the cells they cover
+    paint = np.zeros((grid_rows + 1, grid_cols + 1), dtype=np.int32)
+    np.add.at(paint, (y1, x1), 1)
+    np.add.at(paint, (y1, x2), -1)
+    np.add.at(paint, (y2, x1), -1)
+    np.add.at(paint, (y2, x2), 1)
+    covered = paint.cumsum(axis=0).cumsum(axis=1)[:grid_rows, :grid_cols] > 0
+
+    # summed area table, padded so a window's sum is four lookups
+    table = np.zeros((grid_rows + 1, grid_cols + 1), dtype=np.int64)
+    table[1:, 1:] = covered.cumsum(axis=0).cumsum(axis=1)
 
-            yield satim, [col, row], total
+    cols_start = np.clip(offsets[:, 0] // cell_size, 0, grid_cols)
+    rows_start = np.clip(offsets[:, 1] // cell_size, 0, grid_rows)
+    cols_end = np.clip(-(-(offsets[:, 0] + window_size) // cell_size), 0, grid_cols)
+    rows_end = np.clip(-(-(offsets[:, 1] + window_size) // cell_size), 0, grid_rows)
+
+    hits = (table[rows_end, cols_end] - table[rows_start, cols_end]
+            - table[rows_end, cols_start] + table[rows_start, cols_start])
+    return offsets[hits > 0]
+
+
+def pad_window(window, window_size=1024):
+    """ Pad a window cut short by the edge of the image with zeros on the bottom and right, up to window_size.
+    """
+    pad_rows = window_size - window.shape[0]
+    pad_cols = window_size - window.shape[1]
+    if pad_rows <= 0 and pad_cols <= 0:
+        return window
+
+    padding = [(0, max(pad_rows, 0)), (0, max(pad_cols, 0))] + [(0, 0)] * (window.ndim - 2)
+    return np.pad(window, padding, mode='constant')
+
+
+def read_window(ds, col, row, window_size=1024):
+    # only rasters smaller than a window make us read past the edge, read what there is and pad it
+    xsize = min(window_size, ds.RasterXSize - int(col))
+    ysize = min(window_size, ds.RasterYSize - int(row))
+
+    ds_array = ds.ReadAsArray(int(col), int(row), xsize, ysize)
+    # only the RGB bands, an orthomosaic may also have an alpha band
+    satim = np.moveaxis(ds_array[:3], 0, -1)
+    satim = cv2.cvtColor(satim, cv2.COLOR_RGB2BGR)
+
+    return pad_window(satim, window_size)
+
+
+def _read_rows(ds, row_start, row_end, col_start, col_end):
+    ds_array = ds.ReadAsArray(int(col_start), int(row_start), int(col_end - col_start), int(row_end - row_start))
+    # the RGB bands in BGR order, dropping any alpha band, the same as read_window's cvtColor RGB2BGR.
+    # done as a view so we only copy once into the band
+    return np.moveaxis(ds_array[2::-1], 0, -1)
+
+
+def _to_block(start, end, block_size, length, window_size):
+    """ Widen [start, end) out to whole blocks, unless the blocks are bigger than a window.
+    """
+    if block_size > window_size:
+        return start, end
+    return start // block_size * block_size, min(-(-end // block_size) * block_size, length)
+
+
+def read_windows_banded(ds, offsets, window_size=1024):
+    """ Yield (window, [col, row]) for the row-major offsets, decoding each pixel the windows need only once.
+
+    The raster is read in horizontal bands, extended to the tif's native block height when the blocks are
+    no taller than a window, and the windows are views into the band. A band only spans the columns of the
+    windows that start in it, widened to whole blocks, so the parts of a row with no windows left in them are
+    never decoded. Each time we move down we allocate a new band and carry over the pixels we still need,
+    rather than overwriting the old one, so windows handed out earlier stay valid.
+    """
+    block_width, block_height = ds.GetRasterBand(1).GetBlockSize()
+    rows, cols = ds.RasterYSize, ds.RasterXSize
+
+    offsets = np.asarray(offsets, dtype=np.int64).reshape(-1, 2)
+    if np.any(np.diff(offsets[:, 1]) < 0):
+        raise ValueError("read_windows_banded expects the offsets in row-major order")
+
+    # the first and last window column of each row of windows
+    offset_rows, first = np.unique(offsets[:, 1], return_index=True)
+    row_min_col = np.minimum.reduceat(offsets[:, 0], first) if len(offsets) else first
+    row_max_col = np.maximum.reduceat(offsets[:, 0], first) if len(offsets) else first
+
+    band = None
+    band_start = band_end = band_col_start = 0
+    for col, row in offsets:
+        if band is None or row != band_start:
+            # read up to the end of the block we are in, so no block is decoded twice, unless the blocks are
+            # taller than a window (e.g. a tif stored as one strip) where that would read the whole tif at once
+            read_end = _to_block(row, min(row + window_size, rows), block_height, rows, window_size)[1]
+
+            # every window starting in the band uses it, and the windows starting below it don't reach the rows
+            # we carry over, so the rows we have already read cover every column they still need
+            in_band = slice(np.searchsorted(offset_rows, row), np.searchsorted(offset_rows, read_end))
+            col_start, col_end = _to_block(row_min_col[in_band].min(),
+                                           min(row_max_col[in_band].max() + window_size, cols),
+                                           block_width, cols, window_size)
+
+            kept = min(band_end, read_end) - row if band is not None else 0
+            if kept <= 0:
+                new_band = np.ascontiguousarray(_read_rows(ds, row, read_end, col_start, col_end))
+            else:
+                new_band = np.zeros((read_end - row, col_end - col_start) + band.shape[2:], dtype=band.dtype)
+                shared_start = max(col_start, band_col_start)
+                shared_end = min(col_end, band_col_start + band.shape[1])
+                if shared_start < shared_end:
+                    new_band[:kept, shared_start - col_start:shared_end - col_start] = \
+                        band[row - band_start:row - band_start + kept,
+                             shared_start - band_col_start:shared_end - band_col_start]
+                if kept < read_end - row:
+                    new_band[kept:] = _read_rows(ds, row + kept, read_end, col_start, col_end)
+
+            band = new_band
+            band_start, band_end, band_col_start = row, read_end, col_start
+
+        yield pad_window(band[:window_size, col - band_col_start:col - band_col_start + window_size],
+                         window_size), [col, row]
 
 
 def non_max_suppression_fast(boxes, overlapThresh):
+    """ Non max suppression over rows of [x1, y1, x2, y2, score, ...], returning the picked rows.
+
+    See nms.non_max_suppression, which works on typed arrays and returns indices instead.
+    """
     # if there are no boxes, return an empty list
     if len(boxes) == 0:
         return []
 
-    # initialize the list of picked indexes
-    pick = []
-
-    # grab the coordinates of the bounding boxes
-    x1 = boxes[:, 0].astype(np.float64)
-    y1 = boxes[:, 1].astype(np.float64)
-    x2 = boxes[:, 2].astype(np.float64)
-    y2 = boxes[:, 3].astype(np.float64)
-    score = boxes[:, 4].astype(np.float64)
-
-    # compute the area of the bounding boxes and sort the bounding
-    # boxes by the bottom-right y-coordinate of the bounding box
-    area = (x2 - x1 + 1) * (y2 - y1 + 1)
-    idxs = np.argsort(score)
-
-    # keep looping while some indexes still remain in the indexes
-    # list
-    while len(idxs) > 0:
-        # grab the first index in the indexes list and add the
-        # index value to the list of picked indexes
-        i = idxs[0]
-        pick.append(i)
-
-        # find the largest (x, y) coordinates for the start of
-        # the bounding box and the smallest (x, y) coordinates
-        # for the end of the bounding box
-        xx1 = np.maximum(x1[i], x1[idxs[1:]])
-        yy1 = np.maximum(y1[i], y1[idxs[1:]])
-        xx2 = np.minimum(x2[i], x2[idxs[1:]])
-        yy2 = np.minimum(y2[i], y2[idxs[1:]])
-
-        # compute the width and height of the bounding box
-        w = np.maximum(0, xx2 - xx1 + 1)
-        h = np.maximum(0, yy2 - yy1 + 1)
-
-        # compute the ratio of overlap
-        overlap = (w * h) / area[idxs[1:]]
-
-        # delete all indexes from the index list that have
-        idxs = np.delete(idxs[1:], np.where(overlap > overlapThresh)[0])
-
-    # return only the bounding boxes that were picked using the
-    # integer data type
-    return boxes[pick]
\ No newline at end of file
+    coords = boxes[:, :4].astype(np.float32)
+    score = boxes[:, 4].astype(np.float32)
+
+    pick = non_max_suppression(coords, score, overlapThresh)
+    return boxes[pick]
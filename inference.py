@@ -1,12 +1,14 @@
 import csv
 import glob
+import logging
+import multiprocessing
 import os
-import time
 
 # import miscellaneous modules
 import cv2
 import keras
 import numpy as np
+from osgeo import gdal
 
 
 # set tf backend to allow memory to grow, instead of claiming everything
@@ -15,8 +17,13 @@ import tensorflow as tf
 from keras_retinanet import models
 from keras_retinanet.utils.image import preprocess_image, resize_image
 
-from image_utils import large_tiff_to_windows, non_max_suppression_fast
-from preprocess_data.draw_bounding_box import visualize_bbox
+from debug_renderer import DebugRenderer
+from detections import (DETECTION_DTYPE, SINKS, WindowCheckpoint, batch_to_records, make_sink, read_detections,
+                        records_to_boxes, records_to_rows, resume_sink, sink_path)
+from image_utils import drop_blank_offsets, large_tiff_window_offsets, offsets_near_boxes, window_offsets
+from metrics import Metrics
+from nms import StreamingNMS, non_max_suppression
+from pipeline import read_windows_banded_pipelined, read_windows_pipelined
 
 def get_session():
     config = tf.ConfigProto()
@@ -24,59 +31,50 @@ def get_session():
     return tf.Session(config=config)
 
 
-def get_boxes(img, model):
-    img = img.copy()
-    preprocess_image(img)
+def preprocess_window(img):
+    img = preprocess_image(img)
     img, scale = resize_image(img, min_side=1024, max_side=1024)
 
-    # process image
-    start = time.time()
-    boxes, scores, labels = model.predict_on_batch(np.expand_dims(img, axis=0))
-    print("processing time: ", time.time() - start)
+    return img, scale
 
-    # correct for image scale
-    boxes /= scale
 
-    return boxes, scores, labels
+def predict_batch(processed, model):
+    """ Run the model over a list of (image, scale) pairs from preprocess_window in a single forward pass.
+    """
+    batch = np.stack([img for img, scale in processed])
+    scales = np.array([scale for img, scale in processed], dtype=np.float32)
 
-def load_classes_csv(csv_path):
-    class_dict = {}
-    with open(csv_path, 'r') as f:
-        reader = csv.reader(f)
-        for i, class_row in enumerate(reader):
-            class_dict[int(class_row[1])] = class_row[0]
+    # process the whole batch at once
+    boxes, scores, labels = model.predict_on_batch(batch)
 
-        return class_dict
+    # correct for image scale, each window may have been resized differently
+    boxes /= scales[:, np.newaxis, np.newaxis]
 
-if __name__ == '__main__':
-    import argparse
+    return boxes, scores, labels
 
-    parser = argparse.ArgumentParser(description='Run inference on the given tiles.')
-    parser.add_argument('in_dir', type=str, help='the location of the tiles')
-    parser.add_argument('model_path', type=str, help='the location of the model weights')
-    parser.add_argument('classes_csv', type=str, help='the location of the classes.csv')
-    parser.add_argument('--threshold', type=float, default=0.2,
-                        help='the threshold of the confidence in the boxes we output')
-    parser.add_argument('--nms_overlap', type=float, default=0.15,
-                        help='the overlap threshold we require before discarding overlapping boxes')
-    args = parser.parse_args()
 
-    # set the modified tf session as backend in keras
-    keras.backend.tensorflow_backend.set_session(get_session())
+def batch_windows(windows, batch_size):
+    """ Group the windows into lists of at most batch_size.
+    """
+    batch = []
+    for window_tuple in windows:
+        batch.append(window_tuple)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
 
-    # load retinanet model
-    model = models.load_model(args.model_path, backbone_name='resnet50')
+    if batch:
+        yield batch
 
-    # load label to names mapping for visualization purposes
-    labels_to_names = load_classes_csv(args.classes_csv)
 
+def get_filepaths(in_dir):
     # get the images we want to run on
-    if os.path.isdir(args.in_dir):
-        filepaths = glob.glob(os.path.join(args.in_dir, "*.tif"))
+    if os.path.isdir(in_dir):
+        filepaths = glob.glob(os.path.join(in_dir, "*.tif"))
     else:
         filepaths = []
 
-        with open(args.in_dir, "r") as f:
+        with open(in_dir, "r") as f:
             reader = csv.reader(f)
             for i, row in enumerate(reader):
                 impath, tlx, tly, brx, bry, classification = row
@@ -84,65 +82,415 @@ if __name__ == '__main__':
                 filepaths.append(impath)
     # filepaths = ["./preprocess_data/test.jpg", ]
 
-    # run inference on each image
-    for f_i, filepath in enumerate(filepaths):
-        print("{} {}/{}".format(filepath, f_i, len(filepaths)))
+    return filepaths
+
+
+def output_paths(filepath, shard_index=None):
+    """ The final csv, the prefix of the intermediate detections and the checkpoint for a tif or a shard of it.
+    """
+    outdir = os.path.join(os.path.dirname(filepath), "processed")
+    filename = os.path.basename(filepath).split(".")[0]
+
+    outcsvpath = os.path.join(outdir, filename + ".csv")
+    if shard_index is not None:
+        filename = "{}_shard{}".format(filename, shard_index)
+
+    return (outcsvpath,
+            os.path.join(outdir, str(filename) + "_intermediate"),
+            os.path.join(outdir, str(filename) + "_checkpoint.txt"))
+
+
+def open_intermediate(filepath, intermediate_prefix, checkpoint, labels_to_names, args):
+    """ Open the sink for every detection before suppression, flushed at window boundaries.
+
+    If we are resuming, returns the records the interrupted run already stored, otherwise None.
+    """
+    if args.resume and checkpoint.windows and os.path.exists(sink_path(args.intermediate_format, intermediate_prefix)):
+        return resume_sink(args.intermediate_format, intermediate_prefix, filepath, labels_to_names,
+                           checkpoint, args.flush_every)
+
+    checkpoint.reset()
+    sink = make_sink(args.intermediate_format, intermediate_prefix, filepath, labels_to_names,
+                     args.flush_every, checkpoint)
+    return sink, None
+
+
+def tif_window_offsets(filepath, args, metrics):
+    """ The [col, row] offsets of the windows we run the model on, without the ones we can tell are blank.
+    """
+    offsets = large_tiff_window_offsets(filepath, window_step=256)
+
+    if args.blank_mask_factor:
+        total = len(offsets)
+        with metrics.timer('blank_mask'):
+            offsets = drop_blank_offsets(gdal.Open(filepath), offsets, 1024, args.blank_mask_factor)
+        metrics.increment('windows_blank_mask', total - len(offsets))
+
+    return offsets
+
+
+def coarse_detections(filepath, offsets, model, args, metrics):
+    """ Run the model over the coarse windows at offsets and return every detection above args.coarse_threshold.
+
+    Windows larger than 1024 are shrunk to 1024 by preprocess_window, so a larger coarse window is a cheap
+    look at a downsampled version of the tif.
+    """
+    read_windows = read_windows_banded_pipelined if args.reader == 'band' else read_windows_pipelined
+    windows = read_windows(filepath, offsets, window_size=args.coarse_window_size, preprocess=preprocess_window,
+                           num_workers=args.readers, queue_depth=args.queue_depth, metrics=metrics)
+
+    records = []
+    for batch in batch_windows(windows, args.batch_size):
+        with metrics.timer('coarse_predict'):
+            boxes, scores, labels = predict_batch([window_tuple[2] for window_tuple in batch], model)
+        records.append(batch_to_records(boxes, scores, labels, [window_tuple[1] for window_tuple in batch],
+                                        args.coarse_threshold)[0])
+        metrics.increment('windows_coarse', len(batch))
+        metrics.maybe_report()
+
+    return np.concatenate(records) if records else np.empty((0,), dtype=DETECTION_DTYPE)
+
+
+def schedule_offsets(filepath, offsets, model, args, metrics):
+    """ The fine window offsets worth running the model on.
+
+    With the dense schedule that is all of them. With the adaptive schedule we first run the model over
+    non overlapping coarse windows covering the tif, and keep only the fine windows within
+    args.refine_margin of something it found. A box cut in two by a coarse window edge is still found
+    in part, and the fine windows around it will see it whole. The coarse detections are only used to
+    pick windows, the output comes from the fine windows alone.
+    """
+    if args.schedule == 'dense' or len(offsets) == 0:
+        return offsets
+
+    ds = gdal.Open(filepath)
+    rows, cols = ds.RasterYSize, ds.RasterXSize
+
+    coarse_offsets = window_offsets(rows, cols, args.coarse_window_size, args.coarse_step)
+    if args.blank_mask_factor:
+        coarse_offsets = drop_blank_offsets(ds, coarse_offsets, args.coarse_window_size, args.blank_mask_factor)
+
+    records = coarse_detections(filepath, coarse_offsets, model, args, metrics)
+
+    with metrics.timer('schedule'):
+        fine_offsets = offsets_near_boxes(offsets, records_to_boxes(records), rows, cols, 1024, args.refine_margin)
+    metrics.increment('windows_skipped_coarse', len(offsets) - len(fine_offsets))
+
+    return fine_offsets
+
+
+def skip_blank(windows, sink):
+    """ Pass on the windows that aren't blank, ending the blank ones in sink so they are checkpointed as done.
+
+    A blank window has no detections, so it can be marked before the windows still waiting in a batch.
+    """
+    for window_tuple in windows:
+        if window_tuple[0] is None:
+            sink.end_window(window_tuple[1])
+            continue
+        yield window_tuple
+
 
-        outdir = os.path.join(os.path.dirname(filepath), "processed")
-        filename = os.path.basename(filepath).split(".")[0]
+def run_windows(filepath, offsets, model, labels_to_names, args, metrics, sink, suppressor=None, outwriter=None):
+    """ Run the model over the windows of filepath at offsets, writing every detection to sink.
 
-        outcsvpath = os.path.join(outdir, filename + ".csv")
-        # if os.path.exists(outcsvpath):
-        #     continue
+    If a suppressor is given the suppressed detections are streamed to outwriter as we go.
+    """
+    read_windows = read_windows_banded_pipelined if args.reader == 'band' else read_windows_pipelined
+    windows = read_windows(filepath, offsets, preprocess=preprocess_window,
+                           num_workers=args.readers, queue_depth=args.queue_depth, metrics=metrics, keep_blank=True)
+    windows = skip_blank(windows, sink)
+
+    # only draw the detections if we've been asked to, and then only on a sample of the windows
+    renderer = None
+    if args.debug_render:
+        outdir = os.path.join(os.path.dirname(filepath), "processed", "debug")
+        name = os.path.basename(filepath).split(".")[0]
+        renderer = DebugRenderer(outdir, name, labels_to_names, every=args.debug_render_every)
+
+    window_row = None
+    for batch in batch_windows(windows, args.batch_size):
+        with metrics.timer('predict'):
+            boxes, scores, labels = predict_batch([window_tuple[2] for window_tuple in batch], model)
 
-        allrows = []
-        windows = large_tiff_to_windows(filepath, window_step=256)
-        # windows = [[cv2.imread(filepath),(0,0)],]
-        for w_i, window_tuple in enumerate(windows):
+        # threshold and move every box of the batch into tif coordinates in one go
+        with metrics.timer('postprocess'):
+            batch_offsets = [window_tuple[1] for window_tuple in batch]
+            records, window_index, local_boxes = batch_to_records(boxes, scores, labels, batch_offsets,
+                                                                  args.threshold)
+            window_ends = np.cumsum(np.bincount(window_index, minlength=len(batch)))
+            window_starts = np.concatenate(([0], window_ends[:-1]))
+        metrics.increment('detections_found', len(records))
+
+        for b_i, window_tuple in enumerate(batch):
             window = window_tuple[0]
             tl = window_tuple[1]
-            total = window_tuple[2]
 
-            # ignore completely blank tiles
-            if window.min() == window.max():
-                continue
+            # we've moved down a row, nothing from here on can start above it
+            if suppressor is not None and tl[1] != window_row:
+                with metrics.timer('nms'):
+                    emitted = suppressor.finalise(tl[1])
+                with metrics.timer('write'):
+                    outwriter.writerows(records_to_rows(filepath, emitted, labels_to_names))
+                metrics.increment('detections_emitted', len(emitted))
+                window_row = tl[1]
+
+            window_records = records[window_starts[b_i]:window_ends[b_i]]
+            if suppressor is not None:
+                suppressor.add(window_records)
 
-            boxes, scores, labels = get_boxes(window, model)
+            with metrics.timer('write'):
+                sink.write_records(window_records)
+                sink.end_window(tl)
+
+            if renderer is not None:
+                renderer.submit(window, tl, local_boxes[window_starts[b_i]:window_ends[b_i]],
+                                window_records['score'], window_records['label'])
 
-            for box, score, label in zip(boxes[0], scores[0], labels[0]):
-                if score < args.threshold:
-                    break
+            metrics.increment('windows_processed')
+            metrics.maybe_report()
 
-                b = np.array(box).astype(int)
+    if renderer is not None:
+        renderer.close()
 
-                visualize_bbox(window, (b[0], b[1], b[2], b[3]), label, score=score)
 
-                tl_bounds = tl + b[:2]
-                br_bounds = tl + b[2:]
+def process_tif(filepath, model, labels_to_names, args, metrics):
+    outcsvpath, intermediate_prefix, checkpointpath = output_paths(filepath)
 
-                row = [filepath, tl_bounds[0], tl_bounds[1], br_bounds[0], br_bounds[1], labels_to_names[label], score]
+    # the windows whose detections are already stored in the intermediate file
+    checkpoint = WindowCheckpoint(checkpointpath)
+    if args.resume and checkpoint.complete and os.path.exists(outcsvpath):
+        checkpoint.close()
+        return
 
-                allrows.append(row)
+    sink, stored = open_intermediate(filepath, intermediate_prefix, checkpoint, labels_to_names, args)
 
-                with open(os.path.join(outdir, str(filename) + "_intermediate.csv"), "a") as f:
-                    writer = csv.writer(f)
-                    writer.writerow(row)
+    # boxes are suppressed and written out as soon as the windows have moved past them,
+    # starting with anything we found before being interrupted
+    suppressor = StreamingNMS(args.nms_overlap)
+    if stored is not None:
+        suppressor.add(stored)
+    outcsv = open(outcsvpath, "w")
+    outwriter = csv.writer(outcsv)
 
-            # cv2.imshow("results", window)
-            # cv2.waitKey(1)
-            print("{} {} t:{}/{}  w:{}/{}".format(filepath, tl, f_i + 1, len(filepaths), w_i, total))
+    offsets = tif_window_offsets(filepath, args, metrics)
+    offsets = schedule_offsets(filepath, offsets, model, args, metrics)
+    offsets = np.array([offset for offset in offsets if not checkpoint.is_done(offset)]).reshape(-1, 2)
+    run_windows(filepath, offsets, model, labels_to_names, args, metrics, sink, suppressor, outwriter)
+
+    # Non Max Supress whatever boxes are left at the bottom of the tif
+    with metrics.timer('nms'):
+        emitted = suppressor.flush()
+    with metrics.timer('write'):
+        outwriter.writerows(records_to_rows(filepath, emitted, labels_to_names))
+    metrics.increment('detections_emitted', len(emitted))
+    sink.close()
+    outcsv.close()
+    checkpoint.finish()
+    checkpoint.close()
+
+
+def process_shard(filepath, shard_index, offsets, model, labels_to_names, args, metrics):
+    """ Run a range of the windows of a tif, storing its detections to be merged with the other shards later.
+    """
+    outcsvpath, intermediate_prefix, checkpointpath = output_paths(filepath, shard_index)
+
+    checkpoint = WindowCheckpoint(checkpointpath)
+    if args.resume and checkpoint.complete:
+        checkpoint.close()
+        return
+
+    sink, stored = open_intermediate(filepath, intermediate_prefix, checkpoint, labels_to_names, args)
+
+    # the offsets have already been through schedule_offsets in run_sharded
+    offsets = np.array([offset for offset in offsets if not checkpoint.is_done(offset)]).reshape(-1, 2)
+    run_windows(filepath, offsets, model, labels_to_names, args, metrics, sink)
+
+    sink.close()
+    checkpoint.finish()
+    checkpoint.close()
+
+
+def merge_shards(filepath, num_shards, labels_to_names, args, metrics):
+    """ Combine the detections of every shard of a tif and Non Max Supress them into the final csv.
+    """
+    records = [read_detections(args.intermediate_format, output_paths(filepath, shard_index)[1], labels_to_names)
+               for shard_index in range(num_shards)]
+    records = np.concatenate(records) if records else np.empty((0,), dtype=DETECTION_DTYPE)
+
+    with metrics.timer('nms'):
+        pick = non_max_suppression(records_to_boxes(records), records['score'], args.nms_overlap)
+
+    outcsvpath, intermediate_prefix, checkpointpath = output_paths(filepath)
+    with metrics.timer('write'), open(outcsvpath, "w") as f:
+        writer = csv.writer(f)
+        writer.writerows(records_to_rows(filepath, records[pick], labels_to_names))
+    metrics.increment('detections_emitted', len(pick))
+
+    checkpoint = WindowCheckpoint(checkpointpath)
+    checkpoint.finish()
+    checkpoint.close()
+
+
+def make_metrics(args, suffix=None):
+    path = args.metrics_file
+    if path and suffix is not None:
+        path = "{}.{}".format(path, suffix)
+    return Metrics(report_every=args.metrics_every, prometheus_path=path)
+
+
+# the model, labels and metrics of a worker process, set up once by init_worker
+_worker_model = None
+_worker_labels_to_names = None
+_worker_metrics = None
+
+
+def init_worker(args):
+    global _worker_model, _worker_labels_to_names, _worker_metrics
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+    _worker_metrics = make_metrics(args, suffix=os.getpid())
+
+    keras.backend.tensorflow_backend.set_session(get_session())
+    _worker_model = models.load_model(args.model_path, backbone_name='resnet50')
+    _worker_labels_to_names = load_classes_csv(args.classes_csv)
+
+
+def run_shard_task(task):
+    filepath, shard_index, offsets, args = task
+    process_shard(filepath, shard_index, offsets, _worker_model, _worker_labels_to_names, args, _worker_metrics)
+    _worker_metrics.report()
+    return filepath
+
+
+def run_sharded(filepaths, labels_to_names, args, metrics):
+    """ Split the tifs into shards of at most args.windows_per_shard windows and run them on args.workers processes.
+
+    Each process loads the model once, and a tif's final csv is written as soon as all of its shards are done.
+    With the adaptive schedule the coarse pass runs here, once per tif, so the shards only split the fine
+    windows that are left and no coarse window is run twice.
+    """
+    tasks = []
+    num_shards = {}
+    model = None
+    for filepath in filepaths:
+        outcsvpath, intermediate_prefix, checkpointpath = output_paths(filepath)
+        checkpoint = WindowCheckpoint(checkpointpath)
+        checkpoint.close()
+        if args.resume and checkpoint.complete and os.path.exists(outcsvpath):
+            continue
+
+        offsets = tif_window_offsets(filepath, args, metrics)
+        if args.schedule == 'adaptive':
+            if model is None:
+                keras.backend.tensorflow_backend.set_session(get_session())
+                model = models.load_model(args.model_path, backbone_name='resnet50')
+            offsets = schedule_offsets(filepath, offsets, model, args, metrics)
+        shards = np.array_split(offsets, max(1, int(np.ceil(len(offsets) / float(args.windows_per_shard)))))
+
+        num_shards[filepath] = len(shards)
+        tasks.extend((filepath, shard_index, shard, args) for shard_index, shard in enumerate(shards))
+
+    # the workers have their own models, so give back the memory of the coarse pass's
+    if model is not None:
+        model = None
+        keras.backend.clear_session()
+
+    # tensorflow doesn't survive being forked, so start the workers fresh
+    context = multiprocessing.get_context('spawn')
+    remaining = dict(num_shards)
+    with context.Pool(args.workers, initializer=init_worker, initargs=(args, )) as pool:
+        for filepath in pool.imap_unordered(run_shard_task, tasks):
+            remaining[filepath] -= 1
+            if remaining[filepath] == 0:
+                merge_shards(filepath, num_shards[filepath], labels_to_names, args, metrics)
+                print("{} merged {} shards".format(filepath, num_shards[filepath]))
+                metrics.report()
+
+
+def load_classes_csv(csv_path):
+    class_dict = {}
+    with open(csv_path, 'r') as f:
+        reader = csv.reader(f)
+        for i, class_row in enumerate(reader):
+            class_dict[int(class_row[1])] = class_row[0]
+
+        return class_dict
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run inference on the given tiles.')
+    parser.add_argument('in_dir', type=str, help='the location of the tiles')
+    parser.add_argument('model_path', type=str, help='the location of the model weights')
+    parser.add_argument('classes_csv', type=str, help='the location of the classes.csv')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='the threshold of the confidence in the boxes we output')
+    parser.add_argument('--nms_overlap', type=float, default=0.15,
+                        help='the overlap threshold we require before discarding overlapping boxes')
+    parser.add_argument('--batch-size', type=int, default=8,
+                        help='the number of windows we pass through the model in a single forward pass')
+    parser.add_argument('--intermediate-format', choices=sorted(SINKS), default='csv',
+                        help='how to store every detection before non max suppression')
+    parser.add_argument('--flush-every', type=int, default=None,
+                        help='the number of windows between writes of the intermediate detections to disk')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='start every tif from scratch instead of carrying on from its checkpoint')
+    parser.add_argument('--blank-mask-factor', type=int, default=32,
+                        help='skip blank windows using a mask read at 1/factor resolution before reading them, 0 '
+                             'disables. Only used on tifs with overviews, without them the mask read decodes the '
+                             'whole tif')
+    parser.add_argument('--reader', choices=['band', 'window'], default='band',
+                        help='read the tif in bands so each pixel is decoded once, or read each window separately')
+    parser.add_argument('--readers', type=int, default=2,
+                        help='the number of threads reading and preprocessing windows while the model runs')
+    parser.add_argument('--queue-depth', type=int, default=16,
+                        help='the number of preprocessed windows the readers keep ready for the model')
+    parser.add_argument('--schedule', choices=['dense', 'adaptive'], default='dense',
+                        help='run every window, or only the windows near what a coarse first pass finds')
+    parser.add_argument('--coarse-window-size', type=int, default=1024,
+                        help='with --schedule adaptive, the size of the coarse windows, larger ones are downsampled to 1024')
+    parser.add_argument('--coarse-step', type=int, default=1024,
+                        help='with --schedule adaptive, the step between the coarse windows')
+    parser.add_argument('--coarse-threshold', type=float, default=0.05,
+                        help='with --schedule adaptive, the confidence a coarse detection needs to refine around it')
+    parser.add_argument('--refine-margin', type=int, default=128,
+                        help='with --schedule adaptive, run the fine windows within this many pixels of a coarse detection')
+    parser.add_argument('--debug-render', action='store_true',
+                        help='save a sample of the windows with their detections drawn on, to processed/debug')
+    parser.add_argument('--debug-render-every', type=int, default=100,
+                        help='with --debug-render, draw one in this many windows')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of processes to run inference in, each loads its own copy of the model, '
+                             'and with --schedule adaptive the main process loads one for the coarse pass')
+    parser.add_argument('--windows-per-shard', type=int, default=2000,
+                        help='with more than one worker, large tifs are split into shards of this many windows')
+    parser.add_argument('--metrics-every', type=float, default=30.,
+                        help='the number of seconds between logging the timings and counters')
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help='also write the metrics in the Prometheus text format to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+    metrics = make_metrics(args)
+
+    # load label to names mapping for visualization purposes
+    labels_to_names = load_classes_csv(args.classes_csv)
+
+    filepaths = get_filepaths(args.in_dir)
+
+    if args.workers > 1:
+        run_sharded(filepaths, labels_to_names, args, metrics)
+    else:
+        # set the modified tf session as backend in keras
+        keras.backend.tensorflow_backend.set_session(get_session())
 
-            # cv2.imshow("window", window)
-            # cv2.waitKey(1)
+        # load retinanet model
+        model = models.load_model(args.model_path, backbone_name='resnet50')
 
-        # Non Max Supress the boxes so we remove the overlapped runs
-        if allrows:
-            nprows = np.array(allrows)
-            boxes = nprows[:, [1,2,3,4,6,0,5]]
-            boxes = non_max_suppression_fast(boxes, args.nms_overlap)
-            boxes = boxes[:, [5, 0, 1, 2, 3, 6, 4]]
+        # run inference on each image
+        for f_i, filepath in enumerate(filepaths):
+            print("{} {}/{}".format(filepath, f_i, len(filepaths)))
 
-        # write the final output to file
-        with open(outcsvpath, "w") as f:
-            writer = csv.writer(f)
-            writer.writerows(boxes)
+            process_tif(filepath, model, labels_to_names, args, metrics)
+            metrics.report()
@@ -0,0 +1,105 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., float('inf'))
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics(object):
+    """ Timing histograms and counters for the inference loop, safe to record from the reader threads.
+
+    Every report_every seconds maybe_report() logs a single json line of the totals, and if prometheus_path
+    is given rewrites it with the metrics in the Prometheus text format.
+    """
+
+    def __init__(self, report_every=30., prometheus_path=None, prefix='inference'):
+        self.report_every = report_every
+        self.prometheus_path = prometheus_path
+        self.prefix = prefix
+
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.last_report = time.time()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        yield
+        self.observe(name, time.time() - start)
+
+    def maybe_report(self):
+        if time.time() - self.last_report >= self.report_every:
+            self.report()
+
+    def report(self):
+        self.last_report = time.time()
+
+        with self.lock:
+            summary = {
+                'counters': dict(self.counters),
+                'seconds': {name: {'count': h.count, 'sum': h.sum, 'mean': h.sum / h.count if h.count else None}
+                            for name, h in self.histograms.items()},
+            }
+            prometheus = self.to_prometheus() if self.prometheus_path else None
+
+        logger.info(json.dumps(summary, sort_keys=True))
+
+        if prometheus is not None:
+            # write then rename, so a scraper never sees half a file
+            tmppath = self.prometheus_path + '.tmp'
+            with open(tmppath, 'w') as f:
+                f.write(prometheus)
+            os.replace(tmppath, self.prometheus_path)
+
+    def to_prometheus(self):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            metric = '{}_{}_total'.format(self.prefix, name)
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {}'.format(metric, value))
+
+        for name, h in sorted(self.histograms.items()):
+            metric = '{}_{}_seconds'.format(self.prefix, name)
+            lines.append('# TYPE {} histogram'.format(metric))
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{le="{}"}} {}'.format(metric, le, cumulative))
+            lines.append('{}_sum {}'.format(metric, h.sum))
+            lines.append('{}_count {}'.format(metric, h.count))
+
+        return '\n'.join(lines) + '\n'
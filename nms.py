@@ -0,0 +1,162 @@
+import numpy as np
+
+from detections import DetectionBuffer, records_to_boxes
+
+
+def overlapping_pairs(x1, y1, x2, y2, chunk_size=4096):
+    """ Find every pair of boxes (i, j) that intersect, without comparing every box to every other box.
+
+    The boxes are sorted by x1 and each box is only compared against the boxes that start before it ends
+    (sort and sweep), so the work scales with the number of nearby boxes rather than n^2.
+    Pixel coordinates are inclusive, as in non_max_suppression_fast.
+    """
+    n = len(x1)
+    order = np.argsort(x1, kind='stable')
+    sorted_x1 = x1[order]
+
+    # for each box, the end of the run of boxes that start before it ends
+    ends = np.searchsorted(sorted_x1, x2[order] + 1, side='left')
+
+    pairs_i, pairs_j = [], []
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        positions = np.arange(start, stop)
+        counts = np.maximum(ends[start:stop] - positions - 1, 0)
+        if not counts.any():
+            continue
+
+        # expand each box into its run of candidates
+        first = np.repeat(positions, counts)
+        run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        second = first + 1 + np.arange(counts.sum()) - run_starts
+
+        i, j = order[first], order[second]
+
+        # the sweep only guarantees an x overlap, check y as well
+        overlap = np.minimum(y2[i], y2[j]) - np.maximum(y1[i], y1[j]) + 1 > 0
+        pairs_i.append(i[overlap])
+        pairs_j.append(j[overlap])
+
+    if not pairs_i:
+        return np.empty((0,), dtype=np.int64), np.empty((0,), dtype=np.int64)
+
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def non_max_suppression(boxes, scores, overlap_thresh):
+    """ Non max suppression over float32 (n, 4) boxes [x1, y1, x2, y2] and their (n,) scores.
+
+    Gives the same result as non_max_suppression_fast: boxes are visited in ascending score order, and a
+    box is suppressed when its intersection with an already picked box covers more than overlap_thresh
+    of its own area. Returns the indices of the picked boxes in the order they were picked.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32)
+    if len(boxes) == 0:
+        return np.empty((0,), dtype=np.int64)
+
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    area = (x2 - x1 + 1).astype(np.float64) * (y2 - y1 + 1)
+
+    order = np.argsort(scores, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+
+    # direct each intersecting pair from the box visited first to the box it may suppress
+    i, j = overlapping_pairs(x1, y1, x2, y2)
+    first = np.where(rank[i] < rank[j], i, j)
+    second = np.where(rank[i] < rank[j], j, i)
+
+    # the ratio is taken in float64 so boxes right on the threshold go the same way as before
+    w = np.minimum(x2[first], x2[second]) - np.maximum(x1[first], x1[second]) + 1
+    h = np.minimum(y2[first], y2[second]) - np.maximum(y1[first], y1[second]) + 1
+    suppresses = (w.astype(np.float64) * h) / area[second] > overlap_thresh
+    first, second = first[suppresses], second[suppresses]
+
+    # group the edges by the box doing the suppressing, in visiting order
+    edge_order = np.argsort(rank[first], kind='stable')
+    first, second = first[edge_order], second[edge_order]
+    source_starts = np.flatnonzero(np.diff(first)) + 1
+    source_starts = np.concatenate(([0], source_starts)) if len(first) else source_starts
+    source_ends = np.append(source_starts[1:], len(first))
+
+    # a box's fate only depends on boxes visited before it, so one pass in visiting order is enough
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    for start, end in zip(source_starts, source_ends):
+        if not suppressed[first[start]]:
+            suppressed[second[start:end]] = True
+
+    return order[~suppressed[order]]
+
+
+def connected_components(n, i, j):
+    """ Label the n boxes by the connected component of the graph with edges (i, j) they belong to.
+    """
+    labels = np.arange(n)
+    while True:
+        joined = np.minimum(labels[i], labels[j])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, i, joined)
+        np.minimum.at(new_labels, j, joined)
+        # follow the labels through so long chains collapse quickly
+        new_labels = new_labels[new_labels]
+
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+class StreamingNMS(object):
+    """ Non max suppression for detections that arrive row by row as the sliding window moves down the tif.
+
+    Call finalise(row) once no later detection can start above row. Every group of overlapping boxes that
+    lies entirely above it can't be affected by anything still to come, so it is suppressed and returned
+    straight away, giving the same result as running non_max_suppression over everything at the end while
+    only holding on to the boxes near the current row. Detections are DETECTION_DTYPE records.
+    """
+
+    def __init__(self, overlap_thresh):
+        self.overlap_thresh = overlap_thresh
+        self.pending = DetectionBuffer()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, records):
+        self.pending.append(records)
+
+    def finalise(self, row):
+        """ Suppress and return the records of the groups that end above row.
+        """
+        records = self.pending.records
+        x1, y1 = records['x1'], records['y1']
+        x2, y2 = records['x2'], records['y2']
+
+        # a box is closed once a box starting at row can no longer intersect it
+        closed = y2 + 1 <= row
+        if closed.any() and not closed.all():
+            # only close whole groups of overlapping boxes, otherwise suppression could chain across row
+            i, j = overlapping_pairs(x1, y1, x2, y2)
+            components = connected_components(len(records), i, j)
+            open_components = np.zeros(len(records), dtype=bool)
+            open_components[components[~closed]] = True
+            closed = ~open_components[components]
+
+        return self._emit(closed)
+
+    def flush(self):
+        """ Suppress and return everything that is left.
+        """
+        return self._emit(np.ones(len(self.pending), dtype=bool))
+
+    def _emit(self, closed):
+        records = self.pending.records
+        done = records[closed]
+        pick = non_max_suppression(records_to_boxes(done), done['score'], self.overlap_thresh)
+        emitted = done[pick]
+
+        remaining = records[~closed]
+        self.pending.clear()
+        self.pending.append(remaining)
+
+        return emitted
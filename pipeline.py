@@ -0,0 +1,141 @@
+import collections
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from osgeo import gdal
+
+from image_utils import read_window, read_windows_banded
+
+
+def prefetch(items, fn, num_workers=2, queue_depth=8):
+    """ Apply fn to each item on a pool of threads, yielding the results in the order of items.
+
+    At most queue_depth results are in flight at once, so the workers stay ahead of the consumer
+    without holding the whole image in memory.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+
+            if len(pending) >= queue_depth:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def background(items, queue_depth=8):
+    """ Iterate over items on a background thread, keeping up to queue_depth of them ready.
+    """
+    q = queue.Queue(maxsize=queue_depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                q.put((item, None))
+        except Exception as e:
+            q.put((None, e))
+        q.put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    while True:
+        item, error = q.get()
+        if error is not None:
+            raise error
+        if item is done:
+            break
+        yield item
+
+
+def timed_iter(items, metrics, name):
+    """ Record how long each item of items takes to produce in metrics, under name.
+    """
+    items = iter(items)
+    while True:
+        with metrics.timer(name):
+            item = next(items, None)
+        if item is None:
+            return
+        yield item
+
+
+def process_window(window, offset, preprocess=None, metrics=None):
+    """ Returns (window, offset, preprocessed) or (None, offset, None) if the window is completely blank.
+    """
+    # ignore completely blank tiles
+    if window.min() == window.max():
+        if metrics is not None:
+            metrics.increment('windows_blank')
+        return None, offset, None
+
+    if preprocess is None:
+        return window, offset, None
+
+    if metrics is None:
+        return window, offset, preprocess(window)
+
+    with metrics.timer('preprocess'):
+        return window, offset, preprocess(window)
+
+
+def window_reader(filepath, window_size=1024, preprocess=None, metrics=None):
+    """ Make a function that reads (and optionally preprocesses) the window at a [col, row] offset.
+
+    GDAL datasets can't be shared between threads, so every thread opens its own handle on first use.
+    The function returns (window, offset, preprocessed) or (None, offset, None) if the window is completely blank.
+    """
+    local = threading.local()
+
+    def read(offset):
+        if not hasattr(local, 'ds'):
+            local.ds = gdal.Open(filepath)
+
+        if metrics is None:
+            window = read_window(local.ds, offset[0], offset[1], window_size)
+        else:
+            with metrics.timer('read'):
+                window = read_window(local.ds, offset[0], offset[1], window_size)
+
+        return process_window(window, offset, preprocess, metrics)
+
+    return read
+
+
+def read_windows_pipelined(filepath, offsets, window_size=1024, preprocess=None, num_workers=2, queue_depth=8,
+                           metrics=None, keep_blank=False):
+    """ Read the windows at offsets on a pool of reader threads, skipping blank windows.
+
+    The readers keep up to queue_depth decoded (and preprocessed) windows ready, so disk reads overlap
+    with whatever the consumer is doing with the previous windows. With keep_blank the blank windows
+    come through as (None, offset, None), so the consumer can record that they are done.
+    """
+    read = window_reader(filepath, window_size, preprocess, metrics)
+    for result in prefetch(offsets, read, num_workers, queue_depth):
+        if keep_blank or result[0] is not None:
+            yield result
+
+
+def read_windows_banded_pipelined(filepath, offsets, window_size=1024, preprocess=None, num_workers=2,
+                                  queue_depth=8, metrics=None, keep_blank=False):
+    """ Read the windows at offsets band by band on a background thread, preprocessing them on a thread pool.
+
+    Each pixel is only decoded once, see read_windows_banded. The offsets must be in row-major order.
+    keep_blank is the same as for read_windows_pipelined.
+    """
+    ds = gdal.Open(filepath)
+    windows = read_windows_banded(ds, offsets, window_size)
+    if metrics is not None:
+        windows = timed_iter(windows, metrics, 'read')
+    windows = background(windows, queue_depth)
+
+    def process(window_tuple):
+        return process_window(window_tuple[0], window_tuple[1], preprocess, metrics)
+
+    for result in prefetch(windows, process, num_workers, queue_depth):
+        if keep_blank or result[0] is not None:
+            yield result
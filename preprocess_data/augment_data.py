@@ -2,6 +2,7 @@ import argparse
 import collections
 import os
 import csv
+import sys
 
 import cv2
 import albumentations as A
@@ -53,8 +54,28 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='augment the preprocessed data into more variants.')
     parser.add_argument('train_csv', type=str, help='the location of the training csv')
     parser.add_argument('out_dir', type=str, help='the location of where we store the augmented output')
+    parser.add_argument('--config', type=str, default=None,
+                        help='preview the augmentations in this json (or yaml) config instead, see augmentations.py')
     args = parser.parse_args()
 
+    # build the augmentations once rather than for every variant
+    if args.config:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        from augmentations import build_augmentations, load_augmentation_config
+
+        aug = build_augmentations(load_augmentation_config(args.config))
+    else:
+        aug = get_aug([
+            A.VerticalFlip(),
+            A.HorizontalFlip(),
+            A.RGBShift(),
+            A.Blur(blur_limit=9),
+            A.GaussNoise(),
+            A.OpticalDistortion(distort_limit=0.2),
+            A.ShiftScaleRotate(shift_limit=0.1, rotate_limit=45, scale_limit=0.2),
+            A.GridDistortion()
+        ], min_area=(1024 * 0.05) ** 2)
+
     all_im_rows, bounds_in_im = read_csv_file(args.train_csv)
 
     for im_path in bounds_in_im:
@@ -76,21 +97,10 @@ if __name__ == '__main__':
 
 
         for i in range(100):
-            aug = get_aug([
-                A.VerticalFlip(),
-                A.HorizontalFlip(),
-                A.RGBShift(),
-                A.Blur(blur_limit=9),
-                A.GaussNoise(),
-                A.OpticalDistortion(distort_limit=0.2),
-                A.ShiftScaleRotate(shift_limit=0.1, rotate_limit=45, scale_limit=0.2),
-                A.GridDistortion()
-            ], min_area=(1024 * 0.05) ** 2)
-
             augmented = aug(**annotations)
-            aug = visualize(augmented)
+            aug_img = visualize(augmented)
 
-            cv2.imshow("aug", aug)
+            cv2.imshow("aug", aug_img)
             cv2.imshow("img", img)
             print("done")
             cv2.waitKey(-1)
\ No newline at end of file
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+def cap_shares(shares, cap):
+    """ Scale down any of the shares (which sum to 1) above cap and hand the excess to the others in proportion.
+
+    If cap is too small for every share to fit under it, it is raised to an equal share each.
+    """
+    shares = np.asarray(shares, dtype=np.float64)
+    cap = max(cap, 1. / np.count_nonzero(shares))
+
+    capped = np.zeros(len(shares), dtype=bool)
+    while True:
+        over = ~capped & (shares > cap * (1 + 1e-12))
+        if not over.any():
+            return shares
+
+        capped |= over
+        free = ~capped
+        remaining = 1. - cap * capped.sum()
+        shares = np.where(capped, cap, shares)
+        shares[free] *= remaining / shares[free].sum()
+
+
+def alias_table(probabilities):
+    """ Walker's alias table for drawing from probabilities in constant time, see AliasSampler.
+    """
+    n = len(probabilities)
+    scaled = np.asarray(probabilities, dtype=np.float64) * n / np.sum(probabilities)
+
+    accept = np.ones(n, dtype=np.float64)
+    alias = np.arange(n, dtype=np.int64)
+    small = list(np.nonzero(scaled < 1.)[0])
+    large = list(np.nonzero(scaled >= 1.)[0])
+
+    # each underfull column is topped up by one overfull one
+    while small and large:
+        s, l = small.pop(), large.pop()
+        accept[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1. - scaled[s]
+        (small if scaled[l] < 1. else large).append(l)
+
+    return accept, alias
+
+
+class BalancedSampler(object):
+    """ Draws annotations so each class comes up in proportion to its weight and no tile takes more than tile_quota.
+
+    labels and tiles are the class and source image of every annotation, numbered like the generator's
+    annotations. Without class_weights every class is drawn equally often, and without tile_quota the
+    tiles are left in proportion to the classes they hold. The probabilities are worked out once, and
+    every draw is constant time from an alias table.
+    """
+
+    def __init__(self, labels, tiles, class_weights=None, tile_quota=None):
+        labels = np.asarray(labels, dtype=np.int64)
+        tiles = np.asarray(tiles, dtype=np.int64)
+
+        # share each class's weight between its annotations
+        class_counts = np.bincount(labels)
+        weights = np.zeros(len(class_counts), dtype=np.float64)
+        weights[class_counts > 0] = 1.
+        for label, weight in (class_weights or {}).items():
+            if label < len(weights):
+                weights[label] = weight * (class_counts[label] > 0)
+
+        probabilities = weights[labels] / class_counts[labels]
+        probabilities /= probabilities.sum()
+
+        if tile_quota is not None:
+            tile_shares = np.bincount(tiles, weights=probabilities)
+            capped = cap_shares(tile_shares, tile_quota)
+            scale = np.divide(capped, tile_shares, out=np.zeros_like(capped), where=tile_shares > 0)
+            probabilities *= scale[tiles]
+            probabilities /= probabilities.sum()
+
+        self.probabilities = probabilities
+        self.accept, self.alias = alias_table(probabilities)
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    def sample(self, size, rng=np.random):
+        """ Draw size annotation indices, with replacement.
+        """
+        column = rng.randint(0, len(self.accept), size)
+        return np.where(rng.uniform(size=size) < self.accept[column], column, self.alias[column])
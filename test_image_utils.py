@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+pytest.importorskip('osgeo.gdal')
+
+from image_utils import read_window, read_windows_banded, window_offsets, window_starts
+
+
+class FakeBand(object):
+    def __init__(self, block_size):
+        self.block_size = block_size
+
+    def GetBlockSize(self):
+        return self.block_size
+
+
+class FakeDataset(object):
+    """ Just enough of a gdal dataset for the readers, backed by a (bands, rows, cols) array.
+    """
+
+    def __init__(self, array, block_height=256, block_width=None):
+        self.array = array
+        self.RasterCount, self.RasterYSize, self.RasterXSize = array.shape
+        self.block_height = block_height
+        self.block_width = block_width or self.RasterXSize
+        self.read = np.zeros(array.shape[1:], dtype=np.int32)
+
+    def GetRasterBand(self, i):
+        return FakeBand((self.block_width, self.block_height))
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        assert xoff + xsize <= self.RasterXSize and yoff + ysize <= self.RasterYSize
+        self.read[yoff:yoff + ysize, xoff:xoff + xsize] += 1
+        return self.array[:, yoff:yoff + ysize, xoff:xoff + xsize].copy()
+
+
+def test_window_offsets_cover_every_pixel():
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        rows, cols = rng.randint(1, 3000, 2)
+        window_size = rng.choice([256, 1024])
+        window_step = rng.choice([64, 256, window_size])
+
+        covered = np.zeros((rows, cols), dtype=bool)
+        for col, row in window_offsets(rows, cols, window_size, window_step):
+            covered[row:row + window_size, col:col + window_size] = True
+
+        assert covered.all(), (rows, cols, window_size, window_step)
+
+
+def test_window_starts_add_one_tail_window():
+    rng = np.random.RandomState(1)
+    for _ in range(200):
+        length = rng.randint(1, 5000)
+        window_size = rng.choice([256, 1024])
+        window_step = rng.choice([64, 256, window_size])
+
+        starts = window_starts(length, window_size, window_step)
+        if length <= window_size:
+            assert list(starts) == [0]
+            continue
+
+        stepped = np.arange(0, length - window_size + 1, window_step)
+        assert starts[-1] == length - window_size
+        assert list(starts[:len(stepped)]) == list(stepped)
+        assert len(starts) - len(stepped) == (0 if stepped[-1] == length - window_size else 1)
+
+
+@pytest.mark.parametrize('rows, cols', [(300, 500), (1024, 1024), (1500, 2100)])
+@pytest.mark.parametrize('bands', [3, 4])
+def test_banded_reader_matches_read_window(rows, cols, bands):
+    rng = np.random.RandomState(2)
+    ds = FakeDataset(rng.randint(0, 256, (bands, rows, cols)).astype(np.uint8))
+
+    offsets = window_offsets(rows, cols, 1024, 256)
+    windows = list(read_windows_banded(ds, offsets, 1024))
+    assert len(windows) == len(offsets)
+
+    for window, (col, row) in windows:
+        expected = read_window(ds, col, row, 1024)
+        assert window.shape == (1024, 1024, 3)
+        assert expected.shape == (1024, 1024, 3)
+        assert (window == expected).all()
+
+
+def test_banded_reader_only_reads_the_columns_it_needs():
+    rng = np.random.RandomState(3)
+    ds = FakeDataset(rng.randint(0, 256, (3, 3000, 4000)).astype(np.uint8), block_width=256)
+
+    # a scattered subset of the windows, as left by the blank mask or the adaptive schedule
+    offsets = window_offsets(3000, 4000, 1024, 256)
+    offsets = offsets[rng.uniform(size=len(offsets)) < 0.3]
+
+    for window, (col, row) in read_windows_banded(ds, offsets, 1024):
+        assert (window == read_window(ds, col, row, 1024)).all()
+
+    ds.read[:] = 0
+    for _ in read_windows_banded(ds, offsets, 1024):
+        pass
+
+    needed = np.zeros_like(ds.read, dtype=bool)
+    for col, row in offsets:
+        needed[row:row + 1024, col // 256 * 256:-(-(col + 1024) // 256) * 256] = True
+
+    assert ds.read.max() == 1
+    assert (ds.read[needed] == 1).all()
+    assert ds.read.sum() < ds.read.size
@@ -15,17 +15,16 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
 import random
 
 import cv2
 import numpy as np
 from keras_retinanet.preprocessing.csv_generator import CSVGenerator
-from osgeo import gdal
-from shapely.geometry import Polygon
 
-
-def _clamp(n, minn, maxn):
-    return max(min(maxn, n), minn)
+from box_index import BoxGrid
+from dataset_pool import DatasetPool
+from sampler import BalancedSampler
 
 
 def _order(a, b):
@@ -45,101 +44,233 @@ class TiffGenerator(CSVGenerator):
             csv_data_file,
             csv_class_file,
             base_dir=None,
+            dataset_pool_size=8,
+            gdal_cache_mb=None,
+            seed=None,
+            balanced_sampling=False,
+            class_weights=None,
+            tile_quota=None,
             **kwargs
     ):
+        # the windows are a function of the seed, epoch and annotation index only, so any worker
+        # loading a sample picks the same window for it. set before the base __init__, which calls on_epoch_end
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.epoch = 0
+        self.pid = os.getpid()
+        self.sampler = None
+
         kwargs['group_method'] = 'random'
         super().__init__(csv_data_file, csv_class_file, base_dir, **kwargs)
 
-        self.get_image_data_flat()
+        # the base __init__ shuffling the groups isn't the end of an epoch
+        self.epoch = 0
+
+        # the tifs stay open between samples, each worker process opens its own
+        self.datasets = DatasetPool(dataset_pool_size, gdal_cache_mb)
+
+        # builds the annotation index, unless grouping the images in the base __init__ already has
+        self.size()
+
+        # draw the annotations by class and tile instead of each once an epoch, class_weights maps class names
+        # to their weights and tile_quota caps the fraction of the samples taken from any one image
+        if balanced_sampling:
+            weights = {self.name_to_label(name): weight for name, weight in (class_weights or {}).items()}
+            labels = np.concatenate([self.annotation_labels[image_name] for image_name in self.image_names])
+            self.sampler = BalancedSampler(labels, self.image_data_to_image_index, weights, tile_quota)
+            self.group_images()
 
-    def get_image_data_flat(self):
-        self.image_data_flat = []
-        self.image_data_to_image_index = []
-        for image_index, image_name in enumerate(self.image_data):
-            self.image_data_flat.extend(self.image_data[image_name])
-            self.image_data_to_image_index.extend([image_index, ] * len(self.image_data[image_name]))
+    def build_annotation_index(self):
+        """ Store the boxes of every image as arrays and index them, so a window only has to look at the boxes near it.
 
-        self.annotation_index_window = {}
+        The annotations are numbered across all the images in order, image_offsets holds the number of
+        the first annotation of each image and image_data_to_image_index the image of every annotation.
+        This is only rebuilt if image_data is replaced.
+        """
+        self.annotation_boxes = {}
+        self.annotation_labels = {}
+        self.annotation_index = {}
+        for image_name in self.image_names:
+            annots = self.image_data[image_name]
+            boxes = np.array([[annot['x1'], annot['y1'], annot['x2'], annot['y2']] for annot in annots],
+                             dtype=np.float32).reshape(-1, 4)
+            # make sure x1 <= x2 and y1 <= y2
+            boxes = np.concatenate((np.minimum(boxes[:, :2], boxes[:, 2:]), np.maximum(boxes[:, :2], boxes[:, 2:])),
+                                   axis=1)
+
+            self.annotation_boxes[image_name] = boxes
+            self.annotation_labels[image_name] = np.array([self.name_to_label(annot['class']) for annot in annots],
+                                                          dtype=np.int32)
+            self.annotation_index[image_name] = BoxGrid(boxes, self.image_min_side)
+
+        counts = np.array([len(self.annotation_boxes[image_name]) for image_name in self.image_names], dtype=np.int64)
+        self.image_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.image_data_to_image_index = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+
+        self.indexed_image_data = self.image_data
 
     def size(self):
         """ Size of the dataset.
         """
-        self.get_image_data_flat()
-        return len(self.image_data_flat)
+        # the base generator asks for the size before our __init__ has run
+        if getattr(self, 'indexed_image_data', None) is not self.image_data:
+            self.build_annotation_index()
+        return len(self.image_data_to_image_index)
 
-    def load_image(self, annotation_index):
-        """ Load an image at the annotation_index.
+    def annotation_box(self, annotation_index):
+        """ The [x1, y1, x2, y2] of an annotation, numbered across all the images.
         """
         image_index = self.image_data_to_image_index[annotation_index]
+        return self.annotation_boxes[self.image_names[image_index]][annotation_index - self.image_offsets[image_index]]
 
-        ds = gdal.Open(self.image_path(image_index))
-        tif_height, tif_width = ds.RasterYSize, ds.RasterXSize
+    def sample_window(self, annotation_index, tif_width, tif_height, slot=None):
+        """ The top left of a random window around the annotation at annotation_index, for this epoch.
 
-        annotation = self.image_data_flat[annotation_index]
+        slot is the (group index, position) the annotation was drawn for, so an annotation the sampler
+        draws more than once in an epoch gets a different window each time.
+        """
+        key = [int(annotation_index)] if slot is None else [int(annotation_index)] + [int(v) for v in slot]
+        rng = np.random.RandomState([self.seed, self.epoch] + key)
+        x1, y1, x2, y2 = [int(v) for v in self.annotation_box(annotation_index)]
 
         # randomly select a window around this annotation
         border = 50
-        annotation['x1'], annotation['x2'] = _order(annotation['x1'], annotation['x2'])
-        annotation['y1'], annotation['y2'] = _order(annotation['y1'], annotation['y2'])
-
-        min_x = (annotation['x2'] + border) - self.image_min_side
-        min_y = (annotation['y2'] + border) - self.image_min_side
-        max_x = annotation['x1'] - border
-        max_y = annotation['y1'] - border
+        min_x = (x2 + border) - self.image_min_side
+        min_y = (y2 + border) - self.image_min_side
+        max_x = x1 - border
+        max_y = y1 - border
 
         min_x, max_x = _order(max_x, min_x)
         min_y, max_y = _order(max_y, min_y)
 
-        window_x = random.randint(min_x, max_x)
-        window_y = random.randint(min_y, max_y)
+        window_x = rng.randint(min_x, max_x + 1)
+        window_y = rng.randint(min_y, max_y + 1)
 
         # correct for being out the range of the tif
         window_x = max(min(window_x, tif_width - self.image_min_side), 0)
         window_y = max(min(window_y, tif_height - self.image_min_side), 0)
 
-        ds_array = ds.ReadAsArray(window_x, window_y, self.image_min_side, self.image_min_side)
+        return window_x, window_y
+
+    def load_window(self, annotation_index, slot=None):
+        """ The open tif of the annotation at annotation_index and the window we sample around it.
+        """
+        image_index = self.image_data_to_image_index[annotation_index]
+        ds = self.datasets.get(self.image_path(image_index))
+        return ds, self.sample_window(annotation_index, ds.RasterXSize, ds.RasterYSize, slot)
+
+    def read_window(self, ds, window):
+        ds_array = ds.ReadAsArray(int(window[0]), int(window[1]), self.image_min_side, self.image_min_side)
         image = np.moveaxis(ds_array, 0, -1)
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+    def window_annotations(self, image_index, window):
+        """ The annotations of an image inside the window with its top left at window, in window coordinates.
+        """
+        path = self.image_names[image_index]
+
+        # only the boxes that overlap the window, the same as a positive area of intersection
+        index = self.annotation_index[path].query(window[0], window[1],
+                                                  window[0] + self.image_min_side, window[1] + self.image_min_side)
 
-        # store the window coordinates so that we can get the annotations later
-        self.annotation_index_window[annotation_index] = (window_x, window_y)
+        # move them into the window and clamp them to it, dropping any that end up with no width or height
+        bboxes = self.annotation_boxes[path][index] - np.array([window[0], window[1], window[0], window[1]],
+                                                               dtype=np.float32)
+        np.clip(bboxes, 0, self.image_min_side - 1, out=bboxes)
+        keep = (bboxes[:, 0] != bboxes[:, 2]) & (bboxes[:, 1] != bboxes[:, 3])
 
-        return image
+        return {'labels': self.annotation_labels[path][index[keep]], 'bboxes': bboxes[keep]}
+
+    def load_sample(self, annotation_index, slot=None):
+        """ Load the image, annotations and [x, y] window of the sample at annotation_index, see sample_window for slot.
+        """
+        ds, window = self.load_window(annotation_index, slot)
+        image = self.read_window(ds, window)
+        annotations = self.window_annotations(self.image_data_to_image_index[annotation_index], window)
+        return image, annotations, window
+
+    def load_image(self, annotation_index):
+        """ Load an image at the annotation_index.
+        """
+        ds, window = self.load_window(annotation_index)
+        return self.read_window(ds, window)
 
     def load_annotations(self, annotation_index):
-        """ Load annotations for an image_index.
+        """ Load annotations for the window load_image(annotation_index) reads.
         """
-        image_index = self.image_data_to_image_index[annotation_index]
+        ds, window = self.load_window(annotation_index)
+        return self.window_annotations(self.image_data_to_image_index[annotation_index], window)
 
-        path = self.image_names[image_index]
-        annotations = {'labels': np.empty((0,)), 'bboxes': np.empty((0, 4))}
-
-        window = self.annotation_index_window[annotation_index]
-        del self.annotation_index_window[annotation_index]
-
-        windowpoly = Polygon([
-            window,
-            (window[0], window[1] + self.image_min_side),
-            (window[0] + self.image_min_side, window[1] + self.image_min_side),
-            (window[0] + self.image_min_side, window[1])
-        ])
-
-        for idx, annot in enumerate(self.image_data[path]):
-            bbox = Polygon([
-                (float(annot['x1']), float(annot['y1'])),
-                (float(annot['x1']), float(annot['y2'])),
-                (float(annot['x2']), float(annot['y2'])),
-                (float(annot['x2']), float(annot['y1']))
-            ])
-            intersection = windowpoly.intersection(bbox)
-            if intersection.area > 0:
-                x1 = _clamp(float(annot['x1']) - window[0], 0, self.image_min_side - 1)
-                y1 = _clamp(float(annot['y1']) - window[1], 0, self.image_min_side - 1)
-                x2 = _clamp(float(annot['x2']) - window[0], 0, self.image_min_side - 1)
-                y2 = _clamp(float(annot['y2']) - window[1], 0, self.image_min_side - 1)
-
-                if x1 != x2 and y1 != y2:
-                    annotations['labels'] = np.concatenate((annotations['labels'], [self.name_to_label(annot['class'])]))
-                    annotations['bboxes'] = np.concatenate((annotations['bboxes'], [[x1,y1,x2,y2]]))
-
-        return annotations
+    def load_sample_group(self, group, group_index=None):
+        """ Load the images and annotations of a group of samples, choosing each window once.
+        """
+        # only the sampler draws an annotation more than once an epoch, otherwise the windows stay a function
+        # of the annotation, which is what the crop cache relies on
+        if group_index is None or self.sampler is None:
+            samples = [self.load_sample(annotation_index) for annotation_index in group]
+        else:
+            samples = [self.load_sample(annotation_index, (group_index, position))
+                       for position, annotation_index in enumerate(group)]
+        return [sample[0] for sample in samples], [sample[1] for sample in samples]
+
+    def reseed_worker(self):
+        """ Reseed the global random number generators the first time we are used in a new process.
+
+        Forked workers start with a copy of the parent's random state, so without this every worker
+        would apply the same augmentations.
+        """
+        pid = os.getpid()
+        if pid != self.pid:
+            self.pid = pid
+            worker_seed = np.random.RandomState([self.seed, self.epoch, pid]).randint(2 ** 31)
+            random.seed(worker_seed)
+            np.random.seed(worker_seed)
+
+    def compute_input_output(self, group, group_index=None):
+        """ Compute inputs and target outputs for the network, see Generator.compute_input_output.
+        """
+        self.reseed_worker()
+
+        image_group, annotations_group = self.load_sample_group(group, group_index)
+
+        # check validity of annotations
+        image_group, annotations_group = self.filter_annotations(image_group, annotations_group, group)
+
+        # perform preprocessing steps
+        image_group, annotations_group = self.preprocess_group(image_group, annotations_group)
+
+        # compute network inputs
+        inputs = self.compute_inputs(image_group)
+
+        # compute network targets
+        targets = self.compute_targets(image_group, annotations_group)
+
+        return inputs, targets
+
+    def __getitem__(self, index):
+        """ Keras.sequence function, the same as Generator's but passing the group index down to sample_window.
+        """
+        group = self.groups[index]
+        inputs, targets = self.compute_input_output(group, index)
+        return inputs, targets
+
+    def group_images(self):
+        """ Group the annotations into batches, drawn from the sampler if we have one.
+        """
+        if getattr(self, 'sampler', None) is None:
+            return super(TiffGenerator, self).group_images()
+
+        # as many samples an epoch as there are annotations, rounded up to whole batches
+        num_groups = -(-self.size() // self.batch_size)
+        order = self.sampler.sample(num_groups * self.batch_size, np.random.RandomState([self.seed, self.epoch]))
+        self.groups = order.reshape(num_groups, self.batch_size).tolist()
+
+    def on_epoch_end(self):
+        # move on to new windows
+        self.epoch += 1
+        parent = super(TiffGenerator, self)
+        if hasattr(parent, 'on_epoch_end'):
+            parent.on_epoch_end()
+
+        # and a new draw of the annotations
+        if self.sampler is not None:
+            self.group_images()
@@ -25,7 +25,8 @@ from keras_retinanet.utils.anchors import make_shapes_callback, anchor_targets_b
 from keras_retinanet.utils.keras_version import check_keras_version
 from keras_retinanet.utils.model import freeze as freeze_model
 from keras_retinanet.utils.transform import random_transform_generator
-from augmented_generator import AugmentedGenerator
+from augmentations import load_augmentation_config
+from augmented_generator import AugmentedGenerator, CachedCropGenerator
 
 
 def makedirs(path):
@@ -151,13 +152,32 @@ def create_generators(args):
         flip_y_chance=0.5,
     )
 
-    train_generator = AugmentedGenerator(
+    augmentation_config = None
+    if args.augmentation_config:
+        augmentation_config = load_augmentation_config(args.augmentation_config)
+
+    generator_kwargs = {}
+    if args.crop_cache:
+        generator_class = CachedCropGenerator
+        generator_kwargs['crop_cache'] = args.crop_cache
+    else:
+        generator_class = AugmentedGenerator
+
+    train_generator = generator_class(
         args.annotations,
         args.classes,
+        augmentation_config=augmentation_config,
+        augmentation_engine=args.augmentation_engine,
         transform_generator=transform_generator,
         batch_size=args.batch_size,
         image_min_side=args.image_min_side,
-        image_max_side=args.image_max_side
+        image_max_side=args.image_max_side,
+        dataset_pool_size=args.dataset_pool_size,
+        gdal_cache_mb=args.gdal_cache_mb,
+        balanced_sampling=args.balanced_sampling,
+        class_weights=args.class_weights,
+        tile_quota=args.tile_quota,
+        **generator_kwargs
     )
 
     if args.val_annotations:
@@ -174,6 +194,16 @@ def create_generators(args):
     return train_generator, validation_generator
 
 
+def parse_class_weights(value):
+    """ Parse class weights given as name=weight,name=weight.
+    """
+    weights = {}
+    for item in value.split(','):
+        name, weight = item.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
 def check_args(parsed_args):
     """
     Function to check for inherent contradictions within parsed arguments.
@@ -263,6 +293,29 @@ def parse_args(args):
                         default=1024)
     parser.add_argument('--image-max-side', help='Rescale the image if the largest side is larger than max_side.',
                         type=int, default=1024)
+    parser.add_argument('--balanced-sampling', help='Draw the training annotations balanced by class and tile instead '
+                        'of each once per epoch.', action='store_true')
+    parser.add_argument('--class-weights', help='With --balanced-sampling, how often to draw each class relative to '
+                        'the others, as name=weight,name=weight. Classes not listed have weight 1.',
+                        type=parse_class_weights, default=None)
+    parser.add_argument('--tile-quota', help='With --balanced-sampling, the largest fraction of the samples taken '
+                        'from any one image.', type=float, default=None)
+    parser.add_argument('--crop-cache', help='Train from the crops cached in this directory by crop_cache.py.')
+    parser.add_argument('--augmentation-config',
+                        help='Json (or yaml) file of the augmentations to train with, see augmentations.py.')
+    parser.add_argument('--augmentation-engine', help='Augment each image with albumentations, or whole batches at '
+                        'once with the flips, colour, noise and affine transforms of batch_augment.py.',
+                        choices=['albumentations', 'batch'], default='albumentations')
+    parser.add_argument('--workers', help='Number of threads or processes loading batches in parallel.', type=int,
+                        default=1)
+    parser.add_argument('--multiprocessing', help='Load batches in worker processes instead of threads.',
+                        action='store_true')
+    parser.add_argument('--max-queue-size', help='Number of batches the workers keep ready for training.', type=int,
+                        default=10)
+    parser.add_argument('--dataset-pool-size', help='Number of tifs to keep open in each data loading process.',
+                        type=int, default=8)
+    parser.add_argument('--gdal-cache-mb', help='Size of the GDAL block cache in each data loading process.',
+                        type=int, default=None)
 
     return check_args(parser.parse_args(args))
 
@@ -334,6 +387,9 @@ def main(args=None):
         epochs=args.epochs,
         verbose=1,
         callbacks=callbacks,
+        workers=args.workers,
+        use_multiprocessing=args.multiprocessing,
+        max_queue_size=args.max_queue_size,
     )
 
 